@@ -0,0 +1,57 @@
+from diora.data.reading import tree_to_spans
+
+
+def get_spans(tree):
+    """
+    Returns the non-trivial spans of a binary tree as (pos, size), i.e. every
+    constituent except the single tokens and the whole sentence.
+
+    """
+    spans = tree_to_spans(tree)
+    length = max([size for _, size in spans]) if len(spans) > 0 else 1
+    return set([(pos, size) for pos, size in spans if size < length])
+
+
+def span_f1(spans, other_spans):
+    if len(spans) == 0 and len(other_spans) == 0:
+        return 1.
+    overlap = len(spans & other_spans)
+    if overlap == 0:
+        return 0.
+    precision = overlap / len(other_spans)
+    recall = overlap / len(spans)
+    return 2 * precision * recall / (precision + recall)
+
+
+class TreeAgreement(object):
+    r"""TreeAgreement
+
+    Compares the trees of two parsers on the same sentences, e.g. a reference model
+    and a quantized copy. Reports the average sentence-level span F1 (unlabeled,
+    without trivial spans) and the fraction of identical trees.
+
+    """
+
+    def __init__(self):
+        super(TreeAgreement, self).__init__()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.f1 = 0.
+        self.same = 0
+
+    def update(self, trees, other_trees):
+        for tree, other_tree in zip(trees, other_trees):
+            spans, other_spans = get_spans(tree), get_spans(other_tree)
+            self.count += 1
+            self.f1 += span_f1(spans, other_spans)
+            self.same += int(spans == other_spans)
+
+    def get_result(self):
+        count = max(self.count, 1)
+        result = {}
+        result['count'] = self.count
+        result['span_f1'] = self.f1 / count
+        result['tree_agreement'] = self.same / count
+        return result
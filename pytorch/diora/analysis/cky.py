@@ -1,8 +1,10 @@
 import json
 
+import numpy as np
 import torch
 
 from diora.logging.configuration import get_logger
+from diora.net.diora import BIG, get_constraint_mask, get_split_constraint_mask
 
 
 class ParsePredictor(object):
@@ -13,103 +15,147 @@ class ParsePredictor(object):
         self.idx2word = {v: k for k, v in word2idx.items()}
         self.logger = get_logger()
 
-    def parse_batch(self, batch_map):
-        sentences = batch_map['sentences']
-        batch_size = sentences.shape[0]
-        length = sentences.shape[1]
-        scalars = self.net.saved_scalars
-        device = self.net.device
-        dtype = torch.float32
+        # The (length, chart, backpointers) of the last call to `batched_cky`.
+        self.cky_state = None
 
-        # Assign missing scalars
-        for i in range(length):
-            scalars[0][i] = torch.full((batch_size, 1), 1, dtype=dtype, device=device)
+    def parse_batch(self, batch_map):
+        split_s = self.net.split_s
 
-        trees = self.batched_cky(batch_map, scalars)
+        trees = self.batched_cky(batch_map, split_s)
 
         return trees
 
-    def batched_cky(self, batch_map, scalars):
+    def batched_cky(self, batch_map, split_s, state=None):
+        """
+        Finds the highest scoring tree for each sentence.
+
+        `split_s` has shape (batch_size, ncells, nlevels - 1), where the first `level`
+        entries of cell (level, pos) are its split scores. A windowed chart (see
+        `max_span_width`) has fewer levels than tokens. Then a longer sentence is cut
+        into chunks of `nlevels` tokens, the best tree of each chunk is found, and the
+        chunks are joined right-branching: (chunk_0, (chunk_1, (... chunk_k))).
+
+        If `batch_map` has `constraints`, a list of (pos, size) brackets for each
+        sentence, then the trees have every bracket (see `DioraBase.forward`).
+
+        If `state` is set, then it is the `cky_state` of a previous call on the first
+        tokens of these sentences (see `DioraBase.extend`). The cells that end before
+        the new tokens are copied from it, and only the new cells are computed.
+
+        """
         sentences = batch_map['sentences']
         batch_size = sentences.shape[0]
         length = sentences.shape[1]
-        device = self.net.device
+        nlevels = split_s.shape[2] + 1
+        index = self.net.index
+        offset = index.get_offset(length)
+        ncells = split_s.shape[1]
+        device = split_s.device
         dtype = torch.float32
 
-        # Chart.
-        chart = [torch.full((length-i, batch_size), 1, dtype=dtype, device=device) for i in range(length)]
+        constraints = batch_map.get('constraints', None)
 
-        # Backpointers.
-        bp = {}
-        for ib in range(batch_size):
-            bp[ib] = [[None] * (length - i) for i in range(length)]
-            bp[ib][0] = [i for i in range(length)]
+        with torch.no_grad():
+            split_s = split_s.detach()
 
-        for level in range(1, length):
-            L = length - level
-            N = level
+            allowed = None
+            if constraints is not None:
+                allowed = get_constraint_mask(index, length, nlevels, constraints).to(device)
 
-            for pos in range(L):
+            # Chart.
+            chart = torch.full((batch_size, ncells), 1, dtype=dtype, device=device)
 
-                pairs, lps, rps, sps = [], [], [], []
+            # Backpointers. The split chosen for each cell.
+            bp = torch.full((batch_size, ncells), 0, dtype=torch.int64, device=device)
 
-                # Book-keeping for given span.
-                to_choose = [0] * batch_size
-                to_choose_assert = [False] * batch_size
+            prefix_length = 0
+            if state is not None:
+                prefix_length, prefix_chart, prefix_bp = state
+                prefix_offset = index.get_offset(prefix_length)
+                for level in range(1, min(nlevels, prefix_length)):
+                    L = prefix_length - level
+                    prefix = slice(prefix_offset[level], prefix_offset[level] + L)
+                    chart[:, offset[level]:offset[level]+L] = prefix_chart[:, prefix]
+                    bp[:, offset[level]:offset[level]+L] = prefix_bp[:, prefix]
 
-                # Assumes that the bottom-left most leaf is in the first constituent.
-                spbatch = scalars[level][pos]
+            for level in range(1, nlevels):
+                start = max(0, prefix_length - level)
+                L = length - level - start
+                N = level
+                cells = slice(offset[level] + start, offset[level] + start + L)
 
-                for idx in range(N):
-                    # (level, pos)
-                    l_level = idx
-                    l_pos = pos
-                    r_level = level-idx-1
-                    r_pos = pos+idx+1
+                lidx, ridx = index.get_inside_index(length, level)
+                lidx, ridx = lidx[start*N:], ridx[start*N:]
 
-                    assert l_level >= 0
-                    assert l_pos >= 0
-                    assert r_level >= 0
-                    assert r_pos >= 0
+                ps = chart[:, lidx] + chart[:, ridx]
+                ps = ps.view(batch_size, L, N) + split_s[:, cells, :N].to(dtype)
+                if allowed is not None:
+                    mask = get_split_constraint_mask(allowed, lidx, ridx, cells.start, L)
+                    ps = ps.masked_fill(~mask, -BIG)
+                valmax, argmax = ps.max(2)
 
-                    l = (l_level, l_pos)
-                    r = (r_level, r_pos)
+                chart[:, cells] = valmax
+                bp[:, cells] = argmax
 
-                    lp = chart[l_level][l_pos].view(-1, 1)
-                    rp = chart[r_level][r_pos].view(-1, 1)
-                    sp = spbatch[:, idx].view(-1, 1)
+        self.cky_state = (length, chart, bp)
 
-                    lps.append(lp)
-                    rps.append(rp)
-                    sps.append(sp)
+        # In a packed batch, each sentence has its own root.
+        lengths = batch_map.get('lengths', None)
+        if lengths is None:
+            lengths = [length] * batch_size
+        else:
+            lengths = lengths.tolist()
 
-                    pairs.append((l, r))
+        bp = bp.cpu().numpy()
+        offset = np.array([offset[level] for level in range(nlevels)], dtype=np.int64)
 
+        trees = []
+        for i in range(batch_size):
+            if lengths[i] <= nlevels:
+                tree = self.follow_backpointers(bp[i], offset, lengths[i] - 1, 0)
+            else:
+                tree = self.join_chunks(bp[i], offset, lengths[i], nlevels)
+            trees.append(tree)
+        return trees
 
+    def join_chunks(self, bp, offset, length, width):
+        """
+        Builds a right-branching tree over the best trees of consecutive chunks of
+        `width` tokens. The last chunk may be shorter.
 
-                lps, rps, sps = torch.cat(lps, 1), torch.cat(rps, 1), torch.cat(sps, 1)
+        """
+        chunks = [self.follow_backpointers(bp, offset, min(width, length - pos) - 1, pos)
+                  for pos in range(0, length, width)]
 
-                ps = lps + rps + sps
-                argmax = ps.argmax(1).long()
-                valmax = ps[range(batch_size), argmax]
-                chart[level][pos, :] = valmax
+        tree = chunks[-1]
+        for chunk in reversed(chunks[:-1]):
+            tree = (chunk, tree)
+        return tree
 
-                for i, ix in enumerate(argmax.tolist()):
-                    bp[i][level][pos] = pairs[ix]
+    def follow_backpointers(self, bp, offset, level, pos):
+        """
+        Builds the tree rooted at (level, pos) as nested tuples of leaf positions.
 
-        trees = []
-        for i in range(batch_size):
-            tree = self.follow_backpointers(bp[i], bp[i][-1][0])
-            trees.append(tree)
-        return trees
+        """
+        stack = [(level, pos, False)]
+        output = []
+
+        while len(stack) > 0:
+            level, pos, ready = stack.pop()
 
-    def follow_backpointers(self, bp, pair):
-        if isinstance(pair, int):
-            return pair
+            if level == 0:
+                output.append(pos)
+                continue
 
-        l, r = pair
-        lout = self.follow_backpointers(bp, bp[l[0]][l[1]])
-        rout = self.follow_backpointers(bp, bp[r[0]][r[1]])
+            if ready:
+                r = output.pop()
+                l = output.pop()
+                output.append((l, r))
+                continue
 
-        return (lout, rout)
+            idx = int(bp[offset[level] + pos])
+            stack.append((level, pos, True))
+            stack.append((level - idx - 1, pos + idx + 1, False))
+            stack.append((idx, pos, False))
 
+        return output[0]
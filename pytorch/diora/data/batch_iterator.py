@@ -1,4 +1,4 @@
-from diora.data.dataloader import FixedLengthBatchSampler, SimpleDataset
+from diora.data.dataloader import FixedLengthBatchSampler, PackedBatchSampler, SimpleDataset
 from diora.blocks.negative_sampler import choose_negative_samples
 
 from allennlp.modules.elmo import Elmo, batch_to_ids
@@ -36,6 +36,7 @@ def get_default_config():
         vocab=None,
         length_to_size=None,
         rank=None,
+        packed=False,
     )
 
     return default_config
@@ -78,6 +79,24 @@ class BatchIterator(object):
             self.get_dataset_size(), self.get_dataset_minlen(), self.get_dataset_maxlen()
         )
 
+    def get_batch_shapes(self, **kwargs):
+        """
+        Returns the distinct (batch_size, length) of the batches from `get_iterator`.
+
+        """
+        config = get_config(self.config.copy(), **kwargs)
+        sampler_cls = PackedBatchSampler if config.get('packed', False) else FixedLengthBatchSampler
+        sampler = sampler_cls(SimpleDataset(self.sentences), batch_size=config.get('batch_size'),
+            maxlen=config.get('filter_length'), include_partial=config.get('include_partial'),
+            length_to_size=config.get('length_to_size', None))
+        shapes = sampler.get_batch_shapes()
+        ngpus = config.get('ngpus')
+        if ngpus > 1:
+            # Each rank gets one chunk of the batch (see `partition`).
+            shapes = sorted(set((len(x), length) for batch_size, length in shapes
+                for x in torch.chunk(torch.arange(batch_size), ngpus)), key=lambda x: (x[1], x[0]))
+        return shapes
+
     def choose_negative_samples(self, negative_sampler, k_neg):
         return choose_negative_samples(negative_sampler, k_neg)
 
@@ -96,14 +115,20 @@ class BatchIterator(object):
         negative_sampler = config.get('negative_sampler', None)
         workers = config.get('workers')
         length_to_size = config.get('length_to_size', None)
+        packed = config.get('packed', False)
 
         def collate_fn(batch):
             index, sents = zip(*batch)
+            lengths = [len(x) for x in sents]
+            if packed:
+                maxlen = max(lengths)
+                sents = [list(x) + [0] * (maxlen - len(x)) for x in sents]
             sents = torch.from_numpy(np.array(sents)).long()
 
             batch_map = {}
             batch_map['index'] = index
             batch_map['sents'] = sents
+            batch_map['lengths'] = torch.tensor(lengths, dtype=torch.long) if packed else None
 
             for k, v in self.extra.items():
                 batch_map[k] = [v[idx] for idx in index]
@@ -117,7 +142,8 @@ class BatchIterator(object):
         if self.loader is None:
             rng = np.random.RandomState(seed=random_seed)
             dataset = SimpleDataset(self.sentences)
-            sampler = FixedLengthBatchSampler(dataset, batch_size=batch_size, rng=rng,
+            sampler_cls = PackedBatchSampler if packed else FixedLengthBatchSampler
+            sampler = sampler_cls(dataset, batch_size=batch_size, rng=rng,
                 maxlen=filter_length, include_partial=include_partial, length_to_size=length_to_size)
             loader = torch.utils.data.DataLoader(dataset, shuffle=(sampler is None), num_workers=workers, pin_memory=pin_memory,batch_sampler=sampler, collate_fn=collate_fn)
             self.loader = loader
@@ -127,6 +153,7 @@ class BatchIterator(object):
             for batch in self.loader:
                 index = batch['index']
                 sentences = batch['sents']
+                lengths = batch['lengths']
 
                 batch_size, length = sentences.shape
 
@@ -136,14 +163,18 @@ class BatchIterator(object):
 
                 if cuda:
                     sentences = sentences.cuda()
+                if cuda and lengths is not None:
+                    lengths = lengths.cuda()
                 if cuda and neg_samples is not None:
                     neg_samples = neg_samples.cuda()
 
                 batch_map = {}
+                batch_map['index'] = index
                 batch_map['sentences'] = sentences
                 batch_map['neg_samples'] = neg_samples
                 batch_map['batch_size'] = batch_size
                 batch_map['length'] = length
+                batch_map['lengths'] = lengths
 
                 for k, v in self.extra.items():
                     batch_map[k] = batch[k]
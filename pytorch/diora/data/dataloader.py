@@ -106,6 +106,34 @@ class FixedLengthBatchSampler(Sampler):
 
         return batch_index
 
+    def get_lengths(self):
+        lengths = []
+        for i in range(len(self.data_source)):
+            length = len(self.data_source.dataset[i])
+            if self.maxlen is not None and self.maxlen > 0 and length > self.maxlen:
+                continue
+            lengths.append(length)
+        return lengths
+
+    def get_batch_shapes(self):
+        """
+        Returns the distinct (batch_size, length) of the batches, without drawing from
+        the random state.
+
+        """
+        counts = {}
+        for length in self.get_lengths():
+            counts[length] = counts.get(length, 0) + 1
+
+        shapes = set()
+        for length, count in counts.items():
+            batch_size = self.get_batch_size(length)
+            if count >= batch_size:
+                shapes.add((batch_size, length))
+            if self.include_partial and count % batch_size > 0:
+                shapes.add((count % batch_size, length))
+        return sorted(shapes, key=lambda x: (x[1], x[0]))
+
     def __iter__(self):
         self.reset()
         for _ in range(len(self)):
@@ -115,6 +143,76 @@ class FixedLengthBatchSampler(Sampler):
         return len(self.order)
 
 
+class PackedBatchSampler(FixedLengthBatchSampler):
+    """
+    Batches examples of different lengths together. Examples are sorted by length
+    (ties are shuffled) and then cut into consecutive batches, so each batch mixes
+    only similar lengths and every batch except possibly the last is full.
+
+    """
+
+    def reset(self):
+        # Record the lengths of each example.
+        lengths = []
+        for i in range(len(self.data_source)):
+            x = self.data_source.dataset[i]
+            length = len(x)
+
+            if self.maxlen is not None and self.maxlen > 0 and length > self.maxlen:
+                continue
+
+            lengths.append((length, i))
+
+        # Shuffle ties, then sort by length.
+        self.rng.shuffle(lengths)
+        lengths = sorted(lengths, key=lambda x: x[0])
+
+        # The batch size is determined by the longest example in the batch.
+        batches = []
+        batch = []
+        for length, i in lengths:
+            if len(batch) >= self.get_batch_size(length):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+
+        if len(lengths) > 0 and len(batch) == self.get_batch_size(lengths[-1][0]):
+            batches.append(batch)
+            batch = []
+
+        self.logger.info('# of batches = {}'.format(len(batches)))
+
+        ## Optionally, add partial batch.
+        if self.include_partial and len(batch) > 0:
+            batches.append(batch)
+
+        self.rng.shuffle(batches)
+
+        self.batches = batches
+        self.index = -1
+
+    def get_next_batch(self):
+        self.index += 1
+        return self.batches[self.index]
+
+    def get_batch_shapes(self):
+        # Same as `reset`, but only the lengths are needed.
+        shapes = set()
+        batch = []
+        for length in sorted(self.get_lengths()):
+            if len(batch) >= self.get_batch_size(length):
+                shapes.add((len(batch), batch[-1]))
+                batch = []
+            batch.append(length)
+
+        if len(batch) > 0 and (self.include_partial or len(batch) == self.get_batch_size(batch[-1])):
+            shapes.add((len(batch), batch[-1]))
+        return sorted(shapes, key=lambda x: (x[1], x[0]))
+
+    def __len__(self):
+        return len(self.batches)
+
+
 class SimpleDataset(torch.utils.data.Dataset):
 
     def __init__(self, dataset):
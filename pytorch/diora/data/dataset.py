@@ -159,6 +159,7 @@ def make_batch_iterator(options, dset, shuffle=True, include_partial=False, filt
         options_path=options.elmo_options_path,
         weights_path=options.elmo_weights_path,
         length_to_size=length_to_size,
+        packed=options.packed,
         )
 
     # DIRTY HACK: Makes it easier to print examples later. Should really wrap this within the class.
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+import torch
+
+
+class ChartArena(object):
+    r"""ChartArena
+
+    Recycles chart buffers across batches. Buffers are keyed by shape, dtype and
+    device, and a released buffer is handed out again to the next chart that
+    asks for the same key. Recycled buffers are NOT zero-filled.
+
+    A chart should only be released once nothing will read it again and, when
+    it was built with gradients enabled, once backward has run.
+
+    Free buffers are kept up to `max_bytes`, evicting the least recently used
+    keys first.
+
+    """
+
+    def __init__(self, max_bytes=None):
+        super(ChartArena, self).__init__()
+        self.max_bytes = max_bytes
+        self.free = OrderedDict()
+        self.free_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def nbytes(tensor):
+        return tensor.numel() * tensor.element_size()
+
+    def get(self, shape, dtype=None, device=None):
+        dtype = torch.get_default_dtype() if dtype is None else dtype
+        device = torch.device('cpu') if device is None else torch.device(device)
+        key = (tuple(shape), dtype, device)
+
+        lst = self.free.get(key, None)
+        if lst:
+            self.hits += 1
+            self.free.move_to_end(key)
+            tensor = lst.pop()
+            self.free_bytes -= self.nbytes(tensor)
+            if len(lst) == 0:
+                del self.free[key]
+            return tensor
+
+        self.misses += 1
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    def put(self, tensor):
+        # Drop any autograd history. The storage is shared.
+        tensor = tensor.detach()
+        key = (tuple(tensor.shape), tensor.dtype, tensor.device)
+
+        self.free.setdefault(key, []).append(tensor)
+        self.free.move_to_end(key)
+        self.free_bytes += self.nbytes(tensor)
+
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        while self.free_bytes > self.max_bytes and len(self.free) > 0:
+            key, lst = self.free.popitem(last=False)
+            for tensor in lst:
+                self.free_bytes -= self.nbytes(tensor)
+
+    def release(self, chart):
+        if chart.released:
+            return
+        chart.released = True
+        for tensor in chart.buffers:
+            self.put(tensor)
+
+    def clear(self):
+        self.free.clear()
+        self.free_bytes = 0
+
+    def stats(self):
+        return 'hits={} misses={} free_bytes={}'.format(self.hits, self.misses, self.free_bytes)
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import torch
+
+
+class CachedChart(object):
+    r"""CachedChart
+
+    A chart that was read from a `ChartCache`. It only has the cells that the losses
+    and CKY read: the outside h of the leaves, as a (batch_size, length, size) tensor,
+    and the split scores.
+
+    """
+
+    grad_enabled = False
+
+    def __init__(self, outside_h, split_s):
+        super(CachedChart, self).__init__()
+        self.outside_h = outside_h
+        self.split_s = split_s
+        self.dtype = outside_h.dtype
+        self.nlevels = split_s.shape[2] + 1
+
+    def release(self):
+        pass
+
+
+class ChartCache(object):
+    r"""ChartCache
+
+    The chart cells that the losses read, for every example of the training data, in
+    memory-mapped files under `path` keyed by example index. When fine-tuning with a
+    frozen encoder (DIORA and the embedding projection), an example's chart is the
+    same in every epoch, so it is computed once and only the losses run afterwards.
+
+    For an example with n tokens, the cache has the outside h of its n leaves (read by
+    the reconstruction losses) and the split scores of its cells (read by CKY and the
+    "semi" loss). The split scores are stored without the unused entries of each cell,
+    so they take about n^3 / 6 floats. The files are rewritten by every run.
+
+    """
+
+    def __init__(self, path, lengths, diora):
+        super(ChartCache, self).__init__()
+        self.path = path
+        self.diora = diora
+        self.size = diora.size
+        self.split_index_cache = {}
+
+        lengths = np.array(lengths, dtype=np.int64)
+        nsplits = np.array([self.get_num_splits(n) for n in lengths], dtype=np.int64)
+        self.lengths = lengths
+        self.h_offset = np.concatenate([[0], np.cumsum(lengths * self.size)])
+        self.s_offset = np.concatenate([[0], np.cumsum(nsplits)])
+        self.filled = np.zeros(len(lengths), dtype=bool)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        def memmap(name, n):
+            return np.memmap(os.path.join(path, name), dtype=np.float32, mode='w+', shape=(max(1, n),))
+
+        self.outside_h = memmap('outside_h.f32', self.h_offset[-1])
+        self.split_s = memmap('split_s.f32', self.s_offset[-1])
+
+    def get_num_splits(self, n):
+        nlevels = self.diora.get_num_levels(n)
+        return sum((n - level) * level for level in range(1, nlevels))
+
+    def get_split_index(self, n, length, device=None):
+        """
+        Returns where the split scores of a sentence with `n` tokens are in the flat split
+        scores of a (packed) chart with `length` tokens, in (level, pos, split) order.
+
+        """
+        key = (n, length, device)
+        if key in self.split_index_cache:
+            return self.split_index_cache[key]
+
+        offset = self.diora.index.get_offset(length)
+        S = self.diora.get_num_levels(length) - 1
+        idx = [np.zeros(0, dtype=np.int64)]
+        for level in range(1, self.diora.get_num_levels(n)):
+            cells = offset[level] + np.arange(n - level, dtype=np.int64)
+            idx.append((cells.reshape(-1, 1) * S + np.arange(level).reshape(1, -1)).reshape(-1))
+        idx = torch.from_numpy(np.concatenate(idx)).to(device)
+
+        self.split_index_cache[key] = idx
+        return idx
+
+    def contains(self, index):
+        return bool(self.filled[list(index)].all())
+
+    def write(self, index):
+        """
+        Stores the cells of each example of the last batch of `diora`.
+
+        """
+        chart, length = self.diora.chart, self.diora.length
+        batch_size = len(index)
+        h = chart.outside_h[:, :length].detach().float().cpu().numpy()
+        s = chart.split_s.detach().float().view(batch_size, -1)
+
+        for i, idx in enumerate(index):
+            n = self.lengths[idx]
+            split_index = self.get_split_index(n, length, s.device)
+            self.outside_h[self.h_offset[idx]:self.h_offset[idx + 1]] = h[i, :n].reshape(-1)
+            self.split_s[self.s_offset[idx]:self.s_offset[idx + 1]] = s[i, split_index].cpu().numpy()
+            self.filled[idx] = True
+
+    def read(self, index, length, device=None):
+        """
+        Returns a `CachedChart` with the cells of a batch of examples, padded to `length`
+        tokens.
+
+        """
+        batch_size = len(index)
+        nlevels = self.diora.get_num_levels(length)
+        ncells = nlevels * length - nlevels * (nlevels - 1) // 2
+
+        h = torch.zeros(batch_size, length, self.size)
+        s = torch.zeros(batch_size, ncells * (nlevels - 1))
+
+        for i, idx in enumerate(index):
+            n = self.lengths[idx]
+            split_index = self.get_split_index(n, length)
+            h[i, :n] = torch.from_numpy(self.outside_h[self.h_offset[idx]:self.h_offset[idx + 1]]).view(n, -1)
+            s[i, split_index] = torch.from_numpy(self.split_s[self.s_offset[idx]:self.s_offset[idx + 1]])
+
+        return CachedChart(h.to(device), s.view(batch_size, ncells, nlevels - 1).to(device))
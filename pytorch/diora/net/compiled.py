@@ -0,0 +1,129 @@
+import torch
+
+from diora.net.inference import DioraInference
+from diora.logging.configuration import get_logger
+
+
+def enable_compile(diora, recompile_limit=64):
+    """
+    Runs the inside and outside level functions through torch.compile.
+
+    The graphs have dynamic shapes, so each function only needs a few of them (e.g.
+    the first level, where there is a single split, gets its own). Past
+    `recompile_limit` graphs per function, dynamo would silently run the function
+    eagerly, so that raises an error instead. Use `warmup` to compile the graphs
+    before the first real batch.
+
+    """
+    config = torch._dynamo.config
+    for name in ('recompile_limit', 'cache_size_limit', 'accumulated_recompile_limit',
+                 'accumulated_cache_size_limit'):
+        if hasattr(config, name):
+            setattr(config, name, max(getattr(config, name), recompile_limit))
+    if hasattr(config, 'fail_on_recompile_limit_hit'):
+        config.fail_on_recompile_limit_hit = True
+    diora.compiled = True
+
+
+def get_num_graphs():
+    """
+    Returns the number of graphs compiled for each level function.
+
+    """
+    from diora.net.diora import compiled_funcs
+    from torch._dynamo.eval_frame import _debug_get_cache_entry_list
+    return {func.__name__: len(_debug_get_cache_entry_list(func.__code__)) for func in compiled_funcs}
+
+
+def check_recompile_limit():
+    """
+    Raises an error if any level function reached the recompile limit, in which case
+    dynamo runs it eagerly.
+
+    """
+    config = torch._dynamo.config
+    limit = getattr(config, 'recompile_limit', None)
+    if limit is None:
+        limit = config.cache_size_limit
+    num_graphs = get_num_graphs()
+    for name, n in num_graphs.items():
+        if n >= limit:
+            raise ValueError('{} reached the recompile limit ({} graphs), and would run eagerly.'.format(name, n))
+    return num_graphs
+
+
+def run_batch(diora, x, mode='train', engine=None):
+    """
+    Returns the chart (and in train mode the parameter gradients) for `x`.
+
+    """
+    if mode == 'inference':
+        chart = engine.run(x, outside=diora.outside)
+        tensors = [chart.inside_h, chart.inside_s, chart.outside_h, chart.outside_s]
+        return [t.clone() for t in tensors if t is not None]
+
+    with torch.set_grad_enabled(mode == 'train'):
+        diora(x)
+        tensors = [diora.inside_h, diora.inside_s, diora.outside_h, diora.outside_s]
+        tensors = [t for t in tensors if t is not None]
+        if mode == 'train':
+            # A random projection, so that the unit norm does not cancel the gradient.
+            generator = torch.Generator().manual_seed(11)
+            loss = sum([(t * torch.randn(t.shape, generator=generator).to(t.device)).sum() for t in tensors])
+            params = [p for p in diora.parameters() if p.requires_grad]
+            grads = torch.autograd.grad(loss, params, allow_unused=True)
+            tensors += [g for g in grads if g is not None]
+        tensors = [t.detach().clone() for t in tensors]
+    diora.release_chart()
+    return tensors
+
+
+def check_parity(diora, batch_size, length, mode='train', engine=None):
+    """
+    Runs a random batch eagerly and compiled, and returns the largest difference,
+    relative to the largest magnitude of each tensor when it is above 1 (the
+    gradients grow with the batch). Compiles any graphs that this shape needs as a
+    side effect.
+
+    mode: One of `train` (with gradients), `eval` (no_grad) or `inference` (the
+        `DioraInference` engine).
+
+    """
+    device = next(diora.parameters()).device
+    x = torch.randn(batch_size, length, diora.size, device=device)
+
+    compiled = diora.compiled
+    try:
+        diora.compiled = False
+        expected = run_batch(diora, x, mode, engine)
+        diora.compiled = True
+        actual = run_batch(diora, x, mode, engine)
+    finally:
+        diora.compiled = compiled
+
+    return max([((a - b).abs().max() / a.abs().max().clamp(min=1)).item() for a, b in zip(expected, actual)])
+
+
+def warmup(diora, shapes, mode='train', tol=1e-4):
+    """
+    Compiles the graphs for every (batch_size, length) in `shapes`, and checks them
+    against the eager model.
+
+    """
+    logger = get_logger()
+
+    engine = None
+    if mode == 'inference':
+        engine = DioraInference(diora)
+
+    for batch_size, length in shapes:
+        if length < 2:
+            continue
+        diff = check_parity(diora, batch_size, length, mode=mode, engine=engine)
+        logger.info('compile warmup mode={} batch_size={} length={} diff={:.3g}'.format(
+            mode, batch_size, length, diff))
+        if diff > tol:
+            raise ValueError('Compiled model does not match the eager model (diff={} tol={}).'.format(diff, tol))
+
+    num_graphs = check_recompile_limit()
+    logger.info('compile warmup mode={} graphs={}'.format(mode, num_graphs))
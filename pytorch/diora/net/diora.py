@@ -1,12 +1,17 @@
+import copy
+
+import numpy as np
 import torch
 import torch.nn as nn
 
-from diora.net.outside_index import get_outside_index
+from diora.net.outside_index import get_outside_index, get_outside_split_index
+from diora.net.outside_index import get_window_outside_index
 from diora.net.inside_index import get_inside_index
 from diora.net.offset_cache import get_offset_cache
 
 
 TINY = 1e-8
+BIG = 1e8
 
 
 class UnitNorm(object):
@@ -35,51 +40,248 @@ class BatchInfo(object):
 
 
 class Chart(object):
-    def __init__(self, batch_size, length, size, dtype=None, cuda=False):
+    def __init__(self, batch_size, length, size, dtype=None, cuda=False, projection_size=None,
+                 arena=None, outside=True, fused=False, cell=True, storage_dtype=None, nlevels=None):
         super(Chart, self).__init__()
 
-        ncells = int(length * (1 + length) / 2)
+        # A windowed chart only has the first `nlevels` levels (spans of up to `nlevels`
+        # tokens). The levels are stored in order, so the offsets are the same as in the
+        # full chart.
+        self.nlevels = length if nlevels is None else nlevels
+        ncells = self.nlevels * length - self.nlevels * (self.nlevels - 1) // 2
 
         device = torch.cuda.current_device() if cuda else None
 
+        # The h and c buffers may be stored in lower precision (`storage_dtype`). They are
+        # upcast to `dtype` when read, and the scores are always stored in `dtype`.
+        self.dtype = torch.get_default_dtype() if dtype is None else dtype
+        self.storage_dtype = self.dtype if storage_dtype is None else storage_dtype
+        # `build_net` rejects --fused_chart with --chart_precision, so this is internal.
+        assert not (fused and self.storage_dtype != self.dtype), \
+            'The fused chart stores h, c and s in one buffer, so they must have the same dtype.'
+
+        # Buffers from an arena are recycled and are not zero-filled.
+        self.arena = arena
+        self.buffers = []
+        self.released = False
+        self.grad_enabled = torch.is_grad_enabled()
+
+        def alloc(shape, dtype=self.dtype):
+            if arena is None:
+                tensor = torch.full(shape, 0, dtype=dtype, device=device)
+            else:
+                tensor = arena.get(shape, dtype=dtype, device=device)
+            self.buffers.append(tensor)
+            return tensor
+
+        # Fused layout. The h, c and s of a cell are stored next to each other in one
+        # (B, ncells, 2D+1) buffer, so each child is read with a single gather.
+        self.fused = fused
+        self.inside_hcs, self.outside_hcs = None, None
+
+        # Charts without a cell state (MLP) have no c buffers, and a (B, ncells, D+1)
+        # fused buffer.
+        self.cell = cell
+        csize = size if cell else 0
+
+        def alloc_hcs():
+            hcs = alloc((batch_size, ncells, size + csize + 1))
+            c = hcs[:, :, size:size+csize] if cell else None
+            return hcs, hcs[:, :, :size], c, hcs[:, :, size+csize:]
+
         ## Inside.
-        self.inside_h = torch.full((batch_size, ncells, size), 0, dtype=dtype, device=device)
-        self.inside_c = torch.full((batch_size, ncells, size), 0, dtype=dtype, device=device)
-        self.inside_s = torch.full((batch_size, ncells, 1), 0, dtype=dtype, device=device)
+        if fused:
+            self.inside_hcs, self.inside_h, self.inside_c, self.inside_s = alloc_hcs()
+        else:
+            self.inside_h = alloc((batch_size, ncells, size), self.storage_dtype)
+            self.inside_c = alloc((batch_size, ncells, size), self.storage_dtype) if cell else None
+            self.inside_s = alloc((batch_size, ncells, 1))
+
+        ## Split scores (for CKY). Cell (level, pos) uses the first `level` entries.
+        self.split_s = alloc((batch_size, ncells, self.nlevels - 1))
+
+        ## Outside (not allocated for inside-only charts).
+        self.outside_h, self.outside_c, self.outside_s = None, None, None
+
+        if outside and fused:
+            self.outside_hcs, self.outside_h, self.outside_c, self.outside_s = alloc_hcs()
+        elif outside:
+            self.outside_h = alloc((batch_size, ncells, size), self.storage_dtype)
+            self.outside_c = alloc((batch_size, ncells, size), self.storage_dtype) if cell else None
+            self.outside_s = alloc((batch_size, ncells, 1))
+
+        ## Compose projections (factorized mode).
+        # inside_lp/inside_rp: Each inside cell as the left/right input of the inside compose.
+        # outside_lp: Each inside cell as the sibling input of the outside compose.
+        # outside_rp: Each outside cell as the parent input of the outside compose.
+        self.inside_lp, self.inside_rp = None, None
+        self.outside_lp, self.outside_rp = None, None
+
+        ## Score projections (factorized mode).
+        # inside_sp: Each inside cell as the left input of the inside score.
+        # outside_sp: Each inside cell as the sibling input of the outside score.
+        self.inside_sp, self.outside_sp = None, None
+
+        if projection_size is not None:
+            shape = (batch_size, ncells, projection_size)
+            self.inside_lp = alloc(shape)
+            self.inside_rp = alloc(shape)
+            self.inside_sp = alloc((batch_size, ncells, size))
+            if outside:
+                self.outside_rp = alloc(shape)
+
+    def fill(self, outside, offset, h, c=None, s=None):
+        """
+        Writes the h, c and s (zero if None) of the cells from `offset`. Used for the
+        leaves and the outside root.
+
+        In the fused layout they are written with a single copy into the buffer. With
+        gradients, writing through the h, c and s views one after the other fails when
+        the cells are the whole buffer (a chart with one token).
+
+        """
+        L = h.shape[1]
+        hcs = self.outside_hcs if outside else self.inside_hcs
+        if s is None:
+            s = torch.zeros(h.shape[0], L, 1, dtype=h.dtype, device=h.device)
+
+        if hcs is not None:
+            hcs[:, offset:offset+L] = torch.cat([h, s] if c is None else [h, c, s], -1)
+        elif outside:
+            self.outside_h[:, offset:offset+L] = h
+            if c is not None:
+                self.outside_c[:, offset:offset+L] = c
+            self.outside_s[:, offset:offset+L] = s
+        else:
+            self.inside_h[:, offset:offset+L] = h
+            if c is not None:
+                self.inside_c[:, offset:offset+L] = c
+            self.inside_s[:, offset:offset+L] = s
 
-        ## Outside.
-        self.outside_h = torch.full((batch_size, ncells, size), 0, dtype=dtype, device=device)
-        self.outside_c = torch.full((batch_size, ncells, size), 0, dtype=dtype, device=device)
-        self.outside_s = torch.full((batch_size, ncells, 1), 0, dtype=dtype, device=device)
+    def release(self):
+        if self.arena is not None:
+            self.arena.release(self)
 
 
 class Index(object):
-    def __init__(self, cuda=False):
+    def __init__(self, cuda=False, table=None):
         super(Index, self).__init__()
-        self.cuda = cuda
+        self.table = table
         self.inside_index_cache = {}
         self.outside_index_cache = {}
+        self.outside_split_index_cache = {}
+        self.window_outside_index_cache = {}
         self.offset_cache = {}
+        self.cell_start_cache = {}
+        self.cell_end_cache = {}
+        self.cuda = cuda
+
+    @property
+    def cuda(self):
+        return self._cuda
+
+    @cuda.setter
+    def cuda(self, value):
+        # Cached indices live on a device, so rebuild them when the device changes.
+        self._cuda = value
+        self.inside_index_cache.clear()
+        self.outside_index_cache.clear()
+        self.outside_split_index_cache.clear()
+        self.window_outside_index_cache.clear()
+        self.cell_start_cache.clear()
+        self.cell_end_cache.clear()
+
+    def to_tensor(self, arr):
+        device = torch.cuda.current_device() if self.cuda else None
+        return torch.from_numpy(np.asarray(arr, dtype=np.int64)).to(device)
 
     def get_offset(self, length):
         if length not in self.offset_cache:
             self.offset_cache[length] = get_offset_cache(length)
         return self.offset_cache[length]
 
+    def get_cell_end(self, length, nlevels=None):
+        """
+        Returns the position of the last token of every cell, in chart order.
+        A cell is part of a sentence with n tokens when its end is less than n.
+
+        """
+        nlevels = length if nlevels is None else nlevels
+        if (length, nlevels) not in self.cell_end_cache:
+            cell_end = [pos + level for level in range(nlevels) for pos in range(length - level)]
+            self.cell_end_cache[(length, nlevels)] = self.to_tensor(cell_end)
+        return self.cell_end_cache[(length, nlevels)]
+
+    def get_cell_start(self, length, nlevels=None):
+        """
+        Returns the position of the first token of every cell, in chart order.
+
+        """
+        nlevels = length if nlevels is None else nlevels
+        if (length, nlevels) not in self.cell_start_cache:
+            cell_start = [pos for level in range(nlevels) for pos in range(length - level)]
+            self.cell_start_cache[(length, nlevels)] = self.to_tensor(cell_start)
+        return self.cell_start_cache[(length, nlevels)]
+
     def get_inside_index(self, length, level):
         if (length, level) not in self.inside_index_cache:
-            self.inside_index_cache[(length, level)] = \
-                get_inside_index(length, level,
+            if self.table is not None and self.table.has(length):
+                idx = self.table.get('inside', length, level)
+                idx = tuple(self.to_tensor(x) for x in idx)
+            else:
+                idx = get_inside_index(length, level,
                     self.get_offset(length), cuda=self.cuda)
+            self.inside_index_cache[(length, level)] = idx
         return self.inside_index_cache[(length, level)]
 
     def get_outside_index(self, length, level):
         if (length, level) not in self.outside_index_cache:
-            self.outside_index_cache[(length, level)] = \
-                get_outside_index(length, level,
+            if self.table is not None and self.table.has(length):
+                idx = self.table.get('outside', length, level)
+                idx = tuple(self.to_tensor(x) for x in idx)
+            else:
+                idx = get_outside_index(length, level,
                     self.get_offset(length), cuda=self.cuda)
+            self.outside_index_cache[(length, level)] = idx
         return self.outside_index_cache[(length, level)]
 
+    def get_outside_split_index(self, length, level):
+        """
+        Returns the position of each outside pair's parent split in the flattened
+        split scores (see `get_outside_split_index`). Used by pruned charts.
+
+        """
+        if (length, level) not in self.outside_split_index_cache:
+            self.outside_split_index_cache[(length, level)] = get_outside_split_index(
+                length, level, cuda=self.cuda)
+        return self.outside_split_index_cache[(length, level)]
+
+    def get_window_outside_index(self, length, level, nlevels):
+        """
+        Returns the outside index of a windowed chart (see `get_window_outside_index`),
+        and which of its pairs are valid.
+
+        """
+        if (length, level, nlevels) not in self.window_outside_index_cache:
+            self.window_outside_index_cache[(length, level, nlevels)] = get_window_outside_index(
+                length, level, nlevels, cuda=self.cuda)
+        return self.window_outside_index_cache[(length, level, nlevels)]
+
+
+def matmul(module, key, x):
+    """
+    Returns `x` times the matrix `key` of `module` (see `get_matrices`). If the module
+    was quantized (see diora.net.quantize), then uses its int8 copy of the matrix.
+
+    """
+    if module.quantized is not None:
+        return module.quantized[key](x)
+    return torch.matmul(x, module.get_matrices()[key])
+
+
+def upcast(x, dtype):
+    return x.to(dtype) if x is not None else None
+
 
 # Composition Functions
 
@@ -94,6 +296,7 @@ class TreeLSTM(nn.Module):
             self.W = nn.Parameter(torch.FloatTensor(3 * self.size, self.size))
         self.U = nn.Parameter(torch.FloatTensor(5 * self.size, self.ninput * self.size))
         self.B = nn.Parameter(torch.FloatTensor(5 * self.size))
+        self.quantized = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -101,10 +304,24 @@ class TreeLSTM(nn.Module):
         for i, param in enumerate(params):
             param.data.normal_()
 
+    def get_matrices(self):
+        """
+        Returns the matrices that inputs are multiplied by, keyed for `matmul`.
+
+        """
+        size = self.size
+        matrices = {}
+        if hasattr(self, 'W'):
+            matrices['W'] = self.W.t()
+        matrices['U'] = self.U.t()
+        for i in range(self.ninput):
+            matrices['U{}'.format(i)] = self.U[:, i * size:(i + 1) * size].t()
+        return matrices
+
     def leaf_transform(self, x):
-        W, B = self.W, self.B[:3*self.size]
+        B = self.B[:3*self.size]
 
-        activations = torch.matmul(x, W.t()) + B
+        activations = matmul(self, 'W', x) + B
         a_lst = torch.chunk(activations, 3, dim=-1)
         u = torch.tanh(a_lst[0])
         i = torch.sigmoid(a_lst[1])
@@ -115,12 +332,34 @@ class TreeLSTM(nn.Module):
 
         return h, c
 
+    @property
+    def projection_size(self):
+        return 5 * self.size
+
+    def project(self, h, i):
+        """
+        Returns the contribution of `h` to the gate activations when it is
+        the `i`-th input. Summing the projections of every input (plus the
+        bias) gives the same activations as `forward`.
+
+        """
+        return matmul(self, 'U{}'.format(i), h)
+
     def forward(self, hs, cs, constant=1.0):
-        U, B = self.U, self.B
+        B = self.B
 
         input_h = torch.cat(hs, 1)
 
-        activations = torch.matmul(input_h, U.t()) + B
+        activations = matmul(self, 'U', input_h) + B
+
+        return self.activate(activations, cs, constant)
+
+    def forward_projected(self, ps, cs, constant=1.0):
+        activations = sum(ps) + self.B
+
+        return self.activate(activations, cs, constant)
+
+    def activate(self, activations, cs, constant=1.0):
         a_lst = torch.chunk(activations, 5, dim=1)
         u = torch.tanh(a_lst[0])
         i = torch.sigmoid(a_lst[1])
@@ -147,6 +386,7 @@ class ComposeMLP(nn.Module):
         self.W_1 = nn.Parameter(torch.FloatTensor(self.size, self.size))
         self.B = nn.Parameter(torch.FloatTensor(self.size))
         self.B_1 = nn.Parameter(torch.FloatTensor(self.size))
+        self.quantized = None
         self.reset_parameters()
 
     @property
@@ -164,22 +404,55 @@ class ComposeMLP(nn.Module):
         for i, param in enumerate(params):
             param.data.normal_()
 
+    def get_matrices(self):
+        """
+        Returns the matrices that inputs are multiplied by, keyed for `matmul`.
+
+        """
+        size = self.size
+        matrices = {}
+        if hasattr(self, 'V'):
+            matrices['V'] = self.V
+        matrices['W_0'] = self.W_0
+        matrices['W_1'] = self.W_1
+        for i in range(self.ninput):
+            matrices['W_0{}'.format(i)] = self.W_0[i * size:(i + 1) * size]
+        return matrices
+
     def leaf_transform(self, x):
-        h = torch.tanh(torch.matmul(x, self.V) + self.B)
-        device = torch.cuda.current_device() if self.is_cuda else None
-        c = torch.full(h.shape, 0, dtype=torch.float32, device=device)
+        # There is no cell state.
+        h = torch.tanh(matmul(self, 'V', x) + self.B)
 
-        return h, c
+        return h, None
+
+    @property
+    def projection_size(self):
+        return self.size
+
+    def project(self, h, i):
+        """
+        Returns the contribution of `h` to the first layer when it is the
+        `i`-th input. Only the first layer is linear in the inputs, so the
+        second layer is still applied per split.
+
+        """
+        return matmul(self, 'W_0{}'.format(i), h)
 
     def forward(self, hs, cs, constant=1.0):
         input_h = torch.cat(hs, 1)
-        h = torch.relu(torch.matmul(input_h, self.W_0) + self.B)
-        h = torch.relu(torch.matmul(h, self.W_1) + self.B_1)
+        h = torch.relu(matmul(self, 'W_0', input_h) + self.B)
 
-        device = torch.cuda.current_device() if self.is_cuda else None
-        c = torch.full(h.shape, 0, dtype=torch.float32, device=device)
+        return self.activate(h)
 
-        return h, c
+    def forward_projected(self, ps, cs, constant=1.0):
+        h = torch.relu(sum(ps) + self.B)
+
+        return self.activate(h)
+
+    def activate(self, h):
+        h = torch.relu(matmul(self, 'W_1', h) + self.B_1)
+
+        return h, None
 
 
 # Score Functions
@@ -189,6 +462,7 @@ class Bilinear(nn.Module):
         super(Bilinear, self).__init__()
         self.size = size
         self.mat = nn.Parameter(torch.FloatTensor(self.size, self.size))
+        self.quantized = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -196,101 +470,463 @@ class Bilinear(nn.Module):
         for i, param in enumerate(params):
             param.data.normal_()
 
+    def get_matrices(self):
+        return {'mat': self.mat}
+
     def forward(self, vector1, vector2):
         # bilinear
         # a = 1 (in a more general bilinear function, a is any positive integer)
         # vector1.shape = (b, m)
         # matrix.shape = (m, n)
         # vector2.shape = (b, n)
-        bma = torch.matmul(vector1, self.mat).unsqueeze(1)
+        bma = matmul(self, 'mat', vector1).unsqueeze(1)
         ba = torch.matmul(bma, vector2.unsqueeze(2)).view(-1, 1)
         return ba
 
+    def project(self, vector1):
+        return matmul(self, 'mat', vector1)
+
+    def forward_projected(self, projected1, vector2):
+        # projected1 = self.project(vector1)
+        ba = torch.sum(projected1 * vector2, dim=-1).view(-1, 1)
+        return ba
+
+
+# Compiling
+
+compiled_funcs = {}
+
+
+def get_compiled(func):
+    """
+    Returns `func` compiled with torch.compile. The shapes are dynamic, so the batch
+    size, length and level (and the sizes derived from them) are symbolic, and a few
+    graphs serve every batch (see diora.net.compiled).
+
+    Only the `*_combine` functions are compiled, and they take the gathered cells
+    rather than the chart. A compiled backward may recompute a gather from its input,
+    and the chart is written in place after every level.
+
+    """
+    if func not in compiled_funcs:
+        compiled_funcs[func] = torch.compile(func, dynamic=True)
+    return compiled_funcs[func]
+
+
+# Checkpointing
+
+class CheckpointLevel(torch.autograd.Function):
+    r"""CheckpointLevel
+
+    Runs a level without keeping its intermediates, and recomputes them in backward.
+
+    `torch.utils.checkpoint` can not be used here, since later levels write to the
+    same chart buffers in place. The chart tensors are kept without a version check
+    instead, which is safe because the cells that a level reads are never rewritten.
+    They are detached when recomputing, and their gradients are passed back to the
+    chart as it was when the level ran.
+
+    """
+
+    @staticmethod
+    def forward(ctx, run, ninputs, *tensors):
+        ctx.run = run
+        ctx.ninputs = ninputs
+        ctx.tensors = tensors
+        # Later levels may add gradient history to these buffers.
+        ctx.input_requires_grad = [x.requires_grad for x in tensors]
+        # Recompute under the same autocast settings.
+        ctx.device_type = tensors[0].device.type
+        ctx.autocast = torch.is_autocast_enabled(ctx.device_type)
+        ctx.autocast_dtype = torch.get_autocast_dtype(ctx.device_type)
+        with torch.no_grad():
+            outputs = run(*tensors[:ninputs])
+        return outputs
+
+    @staticmethod
+    def backward(ctx, *grads):
+        ninputs = ctx.ninputs
+        inputs = [x.detach().requires_grad_(r) for x, r in zip(ctx.tensors[:ninputs], ctx.input_requires_grad)]
+        params = list(ctx.tensors[ninputs:])
+        with torch.enable_grad(), torch.autocast(ctx.device_type, dtype=ctx.autocast_dtype, enabled=ctx.autocast):
+            outputs = ctx.run(*inputs)
+
+        pairs = [(x, g) for x, g in zip(outputs, grads) if x.requires_grad and g is not None]
+        wrt = [x for x, r in zip(inputs + params, ctx.input_requires_grad) if r]
+        wrt_grads = iter(torch.autograd.grad([x for x, _ in pairs], wrt, [g for _, g in pairs],
+            allow_unused=True))
+
+        return (None, None) + tuple(next(wrt_grads) if r else None for r in ctx.input_requires_grad)
+
+
+def checkpoint_level(compute, compose_func, score_func, batch_info, chart, index, normalize_func):
+    """
+    Returns `s, hbar, cbar, sbar` from `compute`, keeping only these for backward.
+
+    """
+    # The chart tensors (and outside root) that the level may read.
+    names = [k for k, v in vars(chart).items() if torch.is_tensor(v)]
+    root = getattr(batch_info, 'root', None)
+    has_root_c = root is not None and root[1] is not None
+
+    inputs = [getattr(chart, k) for k in names]
+    if root is not None:
+        inputs += [x for x in root if x is not None]
+    params = list(compose_func.parameters()) + list(score_func.parameters())
+
+    def run(*inputs):
+        level_chart = copy.copy(chart)
+        for k, v in zip(names, inputs):
+            setattr(level_chart, k, v)
+        level_batch_info = batch_info
+        if root is not None:
+            level_batch_info = copy.copy(batch_info)
+            root_h = inputs[len(names)]
+            root_c = inputs[len(names) + 1] if has_root_c else None
+            level_batch_info.root = (root_h, root_c)
+        s, hbar, cbar, sbar = compute(compose_func, score_func, level_batch_info, level_chart,
+            index, normalize_func)[2:]
+        return tuple(x for x in (s, hbar, cbar, sbar) if x is not None)
+
+    outputs = CheckpointLevel.apply(run, len(inputs), *(inputs + params))
+
+    if len(outputs) == 4:
+        return outputs
+    s, hbar, sbar = outputs
+    return s, hbar, None, sbar
+
 
 # Inside
 
+def inside_mask(batch_info, index, h, c, s):
+    """
+    Zeros the cells past the end of shorter sentences in a packed batch. Cells inside
+    a sentence only ever read their own descendants, so they need no other masking.
+
+    """
+    if batch_info.mask is None:
+        return h, c, s
+
+    L = batch_info.end - batch_info.start
+    offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+    mask = batch_info.mask[:, offset:offset+L].unsqueeze(2).to(h.dtype)
+
+    if c is not None:
+        c = c * mask
+
+    return h * mask, c, s * mask
+
+
 def inside_fill_chart(batch_info, chart, index, h, c, s):
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
 
-    offset = index.get_offset(batch_info.length)[batch_info.level]
+    offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
 
     chart.inside_h[:, offset:offset+L] = h
-    chart.inside_c[:, offset:offset+L] = c
+    if c is not None:
+        chart.inside_c[:, offset:offset+L] = c
     chart.inside_s[:, offset:offset+L] = s
 
 
-def get_inside_states(batch_info, chart, index, size):
+def inside_fill_projections(compose_func, score_func, chart, offset, h):
+    L = h.shape[1]
+
+    chart.inside_lp[:, offset:offset+L] = compose_func.project(h, 0)
+    chart.inside_rp[:, offset:offset+L] = compose_func.project(h, 1)
+    chart.inside_sp[:, offset:offset+L] = score_func.project(h)
+
+
+def get_inside_level_index(batch_info, index):
+    """
+    Returns the inside index for the positions [start, end) of this level.
+
+    """
     lidx, ridx = index.get_inside_index(batch_info.length, batch_info.level)
+    N = batch_info.level
+    start, end = batch_info.start * N, batch_info.end * N
+    return lidx[start:end], ridx[start:end]
+
 
-    ls = chart.index_select(index=lidx, dim=1).view(-1, size)
-    rs = chart.index_select(index=ridx, dim=1).view(-1, size)
+def get_inside_states(batch_info, lchart, rchart, index, size):
+    lidx, ridx = get_inside_level_index(batch_info, index)
+
+    ls = lchart.index_select(index=lidx, dim=1).view(-1, size)
+    rs = rchart.index_select(index=ridx, dim=1).view(-1, size)
 
     return ls, rs
 
 
+def get_inside_cells(batch_info, chart, index):
+    """
+    Returns the (left, right) pairs of h, c and s for every (pos, split) at this level.
+
+    """
+    size = batch_info.size
+    csize = size if chart.cell else 0
+
+    if chart.fused:
+        l, r = get_inside_states(batch_info, chart.inside_hcs, chart.inside_hcs, index, size + csize + 1)
+        hs = [l[:, :size], r[:, :size]]
+        cs = [l[:, size:size+csize], r[:, size:size+csize]] if chart.cell else None
+        ss = [l[:, size+csize:], r[:, size+csize:]]
+        return hs, cs, ss
+
+    hs = get_inside_states(batch_info, chart.inside_h, chart.inside_h, index, size)
+    ls, rs = get_inside_states(batch_info, chart.inside_s, chart.inside_s, index, 1)
+
+    cs = None
+    if chart.cell:
+        cs = get_inside_states(batch_info, chart.inside_c, chart.inside_c, index, size)
+        cs = [x.to(chart.dtype) for x in cs]
+
+    return [x.to(chart.dtype) for x in hs], cs, [ls, rs]
+
+
 def inside_compose(compose_func, hs, cs):
     return compose_func(hs, cs)
 
 
-def inside_score(score_func, batch_info, hs, ss):
+def inside_compose_projected(compose_func, ps, cs):
+    return compose_func.forward_projected(ps, cs)
+
+
+def inside_score(score_func, batch_info, hs, ss, mask=None):
     B = batch_info.batch_size
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
     N = batch_info.level
 
     s = score_func(hs[0], hs[1]) + ss[0] + ss[1]
     s = s.view(B, L, N, 1)
+    if mask is not None:
+        s = s.masked_fill(~mask, -BIG)
     p = torch.softmax(s, dim=2)
 
     return s, p
 
 
-def inside_aggregate(batch_info, h, c, s, p, normalize_func):
+def inside_score_projected(score_func, batch_info, sp, h, ss, mask=None):
     B = batch_info.batch_size
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
     N = batch_info.level
 
+    s = score_func.forward_projected(sp, h) + ss[0] + ss[1]
+    s = s.view(B, L, N, 1)
+    if mask is not None:
+        s = s.masked_fill(~mask, -BIG)
+    p = torch.softmax(s, dim=2)
+
+    return s, p
+
+
+def inside_aggregate(batch_info, h, c, s, p, normalize_func):
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+    N = p.shape[2]
+
     h_agg = torch.sum(h.view(B, L, N, -1) * p, 2)
-    c_agg = torch.sum(c.view(B, L, N, -1) * p, 2)
     s_agg = torch.sum(s * p, 2)
-
     h_agg = normalize_func(h_agg)
-    c_agg = normalize_func(c_agg)
+
+    c_agg = None
+    if c is not None:
+        c_agg = torch.sum(c.view(B, L, N, -1) * p, 2)
+        c_agg = normalize_func(c_agg)
 
     return h_agg, c_agg, s_agg
 
 
 def inside_func(compose_func, score_func, batch_info, chart, index, normalize_func):
-    lh, rh = get_inside_states(batch_info, chart.inside_h, index, batch_info.size)
-    lc, rc = get_inside_states(batch_info, chart.inside_c, index, batch_info.size)
-    ls, rs = get_inside_states(batch_info, chart.inside_s, index, 1)
+    """
+    Computes one level and writes it to the chart. When `batch_info.checkpoint` is set,
+    only the level's cells (and split scores) are kept for backward, and the per-split
+    intermediates are recomputed. The returned `h` and `c` are then None.
+
+    """
+    compute = inside_compute_projected if batch_info.factorized else inside_compute
+    if batch_info.constraint is not None:
+        compute = inside_compute_constrained
+    elif batch_info.memo is not None and batch_info.memo.is_memoized(batch_info.level):
+        compute = inside_compute_memo
+    if batch_info.topk is not None and batch_info.level > batch_info.topk:
+        compute = inside_compute_pruned
+    args = (compose_func, score_func, batch_info, chart, index, normalize_func)
+
+    if batch_info.checkpoint:
+        s, hbar, cbar, sbar = checkpoint_level(compute, *args)
+        h, c = None, None
+    else:
+        h, c, s, hbar, cbar, sbar = compute(*args)
+
+    inside_fill_chart(batch_info, chart, index, hbar, cbar, sbar)
 
-    hlst = [lh, rh]
-    clst = [lc, rc]
-    slst = [ls, rs]
+    if batch_info.factorized:
+        offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+        inside_fill_projections(compose_func, score_func, chart, offset, hbar)
 
+    return h, c, s
+
+
+def inside_compute(compose_func, score_func, batch_info, chart, index, normalize_func):
+    hlst, clst, slst = get_inside_cells(batch_info, chart, index)
+
+    combine = get_compiled(inside_combine) if batch_info.compiled else inside_combine
+    return combine(compose_func, score_func, batch_info, index, normalize_func, hlst, clst, slst)
+
+
+def inside_combine(compose_func, score_func, batch_info, index, normalize_func, hlst, clst, slst):
     h, c = inside_compose(compose_func, hlst, clst)
     s, p = inside_score(score_func, batch_info, hlst, slst)
     hbar, cbar, sbar = inside_aggregate(batch_info, h, c, s, p, normalize_func)
+    hbar, cbar, sbar = inside_mask(batch_info, index, hbar, cbar, sbar)
 
-    inside_fill_chart(batch_info, chart, index, hbar, cbar, sbar)
+    return h, c, s, hbar, cbar, sbar
 
-    return h, c, s
+
+def inside_compute_projected(compose_func, score_func, batch_info, chart, index, normalize_func):
+    """
+    Same as `inside_compute`, but reads each child's compose and score projections from
+    the chart rather than multiplying every (cell, split) pair by the weight matrices.
+
+    """
+    size = compose_func.projection_size
+
+    lp, rp = get_inside_states(batch_info, chart.inside_lp, chart.inside_rp, index, size)
+    lidx, _ = get_inside_level_index(batch_info, index)
+    lsp = chart.inside_sp.index_select(index=lidx, dim=1).view(-1, batch_info.size)
+    hlst, clst, slst = get_inside_cells(batch_info, chart, index)
+
+    plst = [lp, rp]
+
+    combine = get_compiled(inside_combine_projected) if batch_info.compiled else inside_combine_projected
+    return combine(compose_func, score_func, batch_info, index, normalize_func, plst, lsp, hlst, clst, slst)
+
+
+def inside_combine_projected(compose_func, score_func, batch_info, index, normalize_func, plst, lsp,
+                             hlst, clst, slst):
+    h, c = inside_compose_projected(compose_func, plst, clst)
+    s, p = inside_score_projected(score_func, batch_info, lsp, hlst[1], slst)
+    hbar, cbar, sbar = inside_aggregate(batch_info, h, c, s, p, normalize_func)
+    hbar, cbar, sbar = inside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
 
 
 # Outside
 
+def get_outside_mask(batch_info, index):
+    """
+    In a packed batch, a (parent, sibling) pair is only valid when the parent is
+    part of the sentence. In a windowed chart, the pairs whose parent is outside of
+    the sentence are not valid either, and with constraints neither are the pairs
+    where a cell crosses a bracket (see "Constraints"). A targeted outside pass only
+    needs the pairs of the cells that contain a target (see `outside_pass`). Returns
+    None when every pair is valid.
+
+    """
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+
+    mask = None
+
+    if is_windowed(batch_info):
+        _, _, valid = index.get_window_outside_index(batch_info.length, batch_info.level, batch_info.nlevels)
+        valid, = select_level_columns(batch_info, (valid,))
+        mask = valid.view(1, -1, L, 1)
+
+    if batch_info.mask is not None:
+        pidx, _ = get_outside_level_index(batch_info, index)
+        packed = batch_info.mask.index_select(index=pidx, dim=1).view(B, -1, L, 1)
+        mask = packed if mask is None else mask & packed
+
+    if batch_info.target_mask is not None:
+        offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+        needed = batch_info.target_mask[:, offset:offset+L].view(B, 1, L, 1)
+        mask = needed if mask is None else mask & needed
+
+    if batch_info.constraint is not None:
+        pidx, sidx = get_outside_level_index(batch_info, index)
+        offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+        constraint = batch_info.constraint
+        allowed = constraint.index_select(index=pidx, dim=1) & constraint.index_select(index=sidx, dim=1)
+        allowed = allowed.view(B, -1, L, 1) & constraint[:, offset:offset+L].view(B, 1, L, 1)
+        mask = allowed if mask is None else mask & allowed
+
+    return mask
+
+
+def outside_mask(batch_info, index, h, c, s):
+    """
+    Zeros the cells past the end of shorter sentences in a packed batch, and sets
+    the root of each sentence that ends at this level.
+
+    """
+    if batch_info.mask is None:
+        return h, c, s
+
+    L = batch_info.end - batch_info.start
+    offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+    mask = batch_info.mask[:, offset:offset+L].unsqueeze(2)
+    root_h, root_c = batch_info.root
+
+    is_root = (batch_info.lengths - 1 == batch_info.level).view(-1, 1, 1)
+    pos = torch.arange(batch_info.start, batch_info.end, device=h.device)
+    is_root = is_root & (pos == 0).view(1, L, 1)
+
+    h = torch.where(is_root, root_h, h * mask.to(h.dtype))
+    if c is not None:
+        c = torch.where(is_root, root_c, c * mask.to(c.dtype))
+    s = torch.where(is_root, torch.zeros_like(s), s * mask.to(s.dtype))
+
+    return h, c, s
+
+
 def outside_fill_chart(batch_info, chart, index, h, c, s):
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
 
-    offset = index.get_offset(batch_info.length)[batch_info.level]
+    offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
 
     chart.outside_h[:, offset:offset+L] = h
-    chart.outside_c[:, offset:offset+L] = c
+    if c is not None:
+        chart.outside_c[:, offset:offset+L] = c
     chart.outside_s[:, offset:offset+L] = s
 
 
+def outside_fill_projections(compose_func, chart, offset, h):
+    L = h.shape[1]
+
+    chart.outside_rp[:, offset:offset+L] = compose_func.project(h, 1)
+
+
+def is_windowed(batch_info):
+    return batch_info.nlevels < batch_info.length
+
+
+def select_level_columns(batch_info, idxs):
+    """
+    Selects the positions [start, end) of each (pair, pos) index in `idxs`.
+
+    """
+    L = batch_info.length - batch_info.level
+    if batch_info.start == 0 and batch_info.end == L:
+        return tuple(idxs)
+    return tuple(idx.view(-1, L)[:, batch_info.start:batch_info.end].reshape(-1) for idx in idxs)
+
+
+def get_outside_level_index(batch_info, index):
+    """
+    Returns the outside index for the positions [start, end) of this level. The index is
+    laid out (pair, pos), so this selects columns.
+
+    """
+    if is_windowed(batch_info):
+        pidx, sidx, _ = index.get_window_outside_index(batch_info.length, batch_info.level, batch_info.nlevels)
+    else:
+        pidx, sidx = index.get_outside_index(batch_info.length, batch_info.level)
+    return select_level_columns(batch_info, (pidx, sidx))
+
+
 def get_outside_states(batch_info, pchart, schart, index, size):
-    pidx, sidx = index.get_outside_index(batch_info.length, batch_info.level)
+    pidx, sidx = get_outside_level_index(batch_info, index)
 
     ps = pchart.index_select(index=pidx, dim=1).view(-1, size)
     ss = schart.index_select(index=sidx, dim=1).view(-1, size)
@@ -298,16 +934,61 @@ def get_outside_states(batch_info, pchart, schart, index, size):
     return ps, ss
 
 
+def get_outside_cells(batch_info, chart, index):
+    """
+    Returns the (sibling, parent) pairs of h, c and s for every (pos, pair) at this level.
+
+    """
+    size = batch_info.size
+    csize = size if chart.cell else 0
+
+    if chart.fused:
+        p, s = get_outside_states(batch_info, chart.outside_hcs, chart.inside_hcs, index, size + csize + 1)
+        hs = [s[:, :size], p[:, :size]]
+        cs = [s[:, size:size+csize], p[:, size:size+csize]] if chart.cell else None
+        ss = [s[:, size+csize:], p[:, size+csize:]]
+        return hs, cs, ss
+
+    ph, sh = get_outside_states(batch_info, chart.outside_h, chart.inside_h, index, size)
+    ps, ss = get_outside_states(batch_info, chart.outside_s, chart.inside_s, index, 1)
+
+    cs = None
+    if chart.cell:
+        pc, sc = get_outside_states(batch_info, chart.outside_c, chart.inside_c, index, size)
+        cs = [sc.to(chart.dtype), pc.to(chart.dtype)]
+
+    return [sh.to(chart.dtype), ph.to(chart.dtype)], cs, [ss, ps]
+
+
 def outside_compose(compose_func, hs, cs):
     return compose_func(hs, cs, 0)
 
 
-def outside_score(score_func, batch_info, hs, ss):
+def outside_compose_projected(compose_func, ps, cs):
+    return compose_func.forward_projected(ps, cs, 0)
+
+
+def outside_score(score_func, batch_info, hs, ss, mask=None):
     B = batch_info.batch_size
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
 
     s = score_func(hs[0], hs[1]) + ss[0] + ss[1]
     s = s.view(B, -1, L, 1)
+    if mask is not None:
+        s = s.masked_fill(~mask, -BIG)
+    p = torch.softmax(s, dim=1)
+
+    return s, p
+
+
+def outside_score_projected(score_func, batch_info, sp, h, ss, mask=None):
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+
+    s = score_func.forward_projected(sp, h) + ss[0] + ss[1]
+    s = s.view(B, -1, L, 1)
+    if mask is not None:
+        s = s.masked_fill(~mask, -BIG)
     p = torch.softmax(s, dim=1)
 
     return s, p
@@ -315,40 +996,450 @@ def outside_score(score_func, batch_info, hs, ss):
 
 def outside_aggregate(batch_info, h, c, s, p, normalize_func):
     B = batch_info.batch_size
-    L = batch_info.length - batch_info.level
+    L = batch_info.end - batch_info.start
     N = s.shape[1]
 
     h_agg = torch.sum(h.view(B, N, L, -1) * p, 1)
-    c_agg = torch.sum(c.view(B, N, L, -1) * p, 1)
     s_agg = torch.sum(s * p, 1)
-
     h_agg = normalize_func(h_agg)
-    c_agg = normalize_func(c_agg)
+
+    c_agg = None
+    if c is not None:
+        c_agg = torch.sum(c.view(B, N, L, -1) * p, 1)
+        c_agg = normalize_func(c_agg)
 
     return h_agg, c_agg, s_agg
 
 
 def outside_func(compose_func, score_func, batch_info, chart, index, normalize_func):
-    ph, sh = get_outside_states(
-        batch_info, chart.outside_h, chart.inside_h, index, batch_info.size)
-    pc, sc = get_outside_states(
-        batch_info, chart.outside_c, chart.inside_c, index, batch_info.size)
-    ps, ss = get_outside_states(
-        batch_info, chart.outside_s, chart.inside_s, index, 1)
+    """
+    Computes one level and writes it to the chart. See `inside_func` for checkpointing.
+
+    """
+    compute = outside_compute_projected if batch_info.factorized else outside_compute
+    if batch_info.constraint is not None or batch_info.target_mask is not None:
+        compute = outside_compute_constrained
+    if batch_info.topk is not None:
+        compute = outside_compute_pruned
+    args = (compose_func, score_func, batch_info, chart, index, normalize_func)
+
+    if batch_info.checkpoint:
+        s, hbar, cbar, sbar = checkpoint_level(compute, *args)
+        h, c = None, None
+    else:
+        h, c, s, hbar, cbar, sbar = compute(*args)
+
+    outside_fill_chart(batch_info, chart, index, hbar, cbar, sbar)
+
+    if batch_info.factorized:
+        offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+        outside_fill_projections(compose_func, chart, offset, hbar)
+
+    return h, c, s
 
-    hlst = [sh, ph]
-    clst = [sc, pc]
-    slst = [ss, ps]
 
+def outside_compute(compose_func, score_func, batch_info, chart, index, normalize_func):
+    hlst, clst, slst = get_outside_cells(batch_info, chart, index)
+
+    mask = get_outside_mask(batch_info, index)
+
+    combine = get_compiled(outside_combine) if batch_info.compiled else outside_combine
+    return combine(compose_func, score_func, batch_info, index, normalize_func, hlst, clst, slst, mask)
+
+
+def outside_combine(compose_func, score_func, batch_info, index, normalize_func, hlst, clst, slst, mask):
     h, c = outside_compose(compose_func, hlst, clst)
-    s, p = outside_score(score_func, batch_info, hlst, slst)
+    s, p = outside_score(score_func, batch_info, hlst, slst, mask=mask)
     hbar, cbar, sbar = outside_aggregate(batch_info, h, c, s, p, normalize_func)
+    hbar, cbar, sbar = outside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
+
+
+def outside_compute_projected(compose_func, score_func, batch_info, chart, index, normalize_func):
+    size = compose_func.projection_size
+
+    pp, sp = get_outside_states(
+        batch_info, chart.outside_rp, chart.outside_lp, index, size)
+    _, sidx = get_outside_level_index(batch_info, index)
+    ssp = chart.outside_sp.index_select(index=sidx, dim=1).view(-1, batch_info.size)
+    hlst, clst, slst = get_outside_cells(batch_info, chart, index)
+
+    plst = [sp, pp]
+
+    mask = get_outside_mask(batch_info, index)
+
+    combine = get_compiled(outside_combine_projected) if batch_info.compiled else outside_combine_projected
+    return combine(compose_func, score_func, batch_info, index, normalize_func, plst, ssp,
+                   hlst, clst, slst, mask)
+
+
+def outside_combine_projected(compose_func, score_func, batch_info, index, normalize_func, plst, ssp,
+                              hlst, clst, slst, mask):
+    h, c = outside_compose_projected(compose_func, plst, clst)
+    s, p = outside_score_projected(score_func, batch_info, ssp, hlst[1], slst, mask=mask)
+    hbar, cbar, sbar = outside_aggregate(batch_info, h, c, s, p, normalize_func)
+    hbar, cbar, sbar = outside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
+
+
+# Pruning
+#
+# With `topk`, every split of a cell is scored (cheap in factorized mode), but only
+# the k best splits are composed and aggregated, so the cost of a level is
+# O(L * k) compositions instead of O(L * N). The other splits get a score of -BIG in
+# `split_s`, which excludes them from CKY. The outside pass only uses the (parent,
+# sibling) pairs whose split the parent kept, and composes at most k of them.
+
+def select_splits(batch_info, xs, idx, dim):
+    """
+    Returns the rows of each tensor in `xs` for the splits (or pairs) in `idx`. `dim` is
+    the split dimension, 2 for the inside (B, L, N) layout and 1 for the outside
+    (B, N, L) layout.
+
+    """
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+
+    def select(x):
+        size = x.shape[-1]
+        x = x.view(B, -1, L, size) if dim == 1 else x.view(B, L, -1, size)
+        return x.gather(dim, idx.expand(*idx.shape[:3], size)).reshape(-1, size)
+
+    return [select(x) for x in xs]
+
+
+def get_outside_split_mask(batch_info, chart, index):
+    """
+    Returns whether each (parent, sibling) pair uses a split that the parent kept, and
+    is part of the sentence in a packed batch.
+
+    """
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+
+    idx = index.get_outside_split_index(batch_info.length, batch_info.level)
+    if L != batch_info.length - batch_info.level:
+        idx = idx.view(-1, batch_info.length - batch_info.level)[:, batch_info.start:batch_info.end].reshape(-1)
+    keep = chart.split_s.view(B, -1).index_select(index=idx, dim=1).view(B, -1, L, 1) > -BIG / 2
+
+    mask = get_outside_mask(batch_info, index)
+    return keep if mask is None else keep & mask
+
+
+def inside_compute_pruned(compose_func, score_func, batch_info, chart, index, normalize_func):
+    hlst, clst, slst = get_inside_cells(batch_info, chart, index)
+
+    mask = get_inside_mask(batch_info, index)
+
+    if batch_info.factorized:
+        size = compose_func.projection_size
+        plst = list(get_inside_states(batch_info, chart.inside_lp, chart.inside_rp, index, size))
+        lidx, _ = get_inside_level_index(batch_info, index)
+        lsp = chart.inside_sp.index_select(index=lidx, dim=1).view(-1, batch_info.size)
+        s, _ = inside_score_projected(score_func, batch_info, lsp, hlst[1], slst, mask=mask)
+    else:
+        s, _ = inside_score(score_func, batch_info, hlst, slst, mask=mask)
+
+    topk, idx = s.topk(batch_info.topk, dim=2)
+
+    if clst is not None:
+        clst = select_splits(batch_info, clst, idx, 2)
+    if batch_info.factorized:
+        h, c = inside_compose_projected(compose_func, select_splits(batch_info, plst, idx, 2), clst)
+    else:
+        h, c = inside_compose(compose_func, select_splits(batch_info, hlst, idx, 2), clst)
+
+    p = torch.softmax(topk, dim=2)
+    hbar, cbar, sbar = inside_aggregate(batch_info, h, c, topk, p, normalize_func)
+    hbar, cbar, sbar = inside_mask(batch_info, index, hbar, cbar, sbar)
+
+    s = torch.full_like(s, -BIG).scatter(2, idx, topk)
+
+    return h, c, s, hbar, cbar, sbar
+
+
+def outside_compute_pruned(compose_func, score_func, batch_info, chart, index, normalize_func):
+    hlst, clst, slst = get_outside_cells(batch_info, chart, index)
+
+    mask = get_outside_split_mask(batch_info, chart, index)
+
+    if batch_info.factorized:
+        size = compose_func.projection_size
+        pp, sp = get_outside_states(batch_info, chart.outside_rp, chart.outside_lp, index, size)
+        plst = [sp, pp]
+        _, sidx = get_outside_level_index(batch_info, index)
+        ssp = chart.outside_sp.index_select(index=sidx, dim=1).view(-1, batch_info.size)
+        s, _ = outside_score_projected(score_func, batch_info, ssp, hlst[1], slst, mask=mask)
+    else:
+        s, _ = outside_score(score_func, batch_info, hlst, slst, mask=mask)
+
+    if s.shape[1] > batch_info.topk:
+        s, idx = s.topk(batch_info.topk, dim=1)
+        hlst = select_splits(batch_info, hlst, idx, 1)
+        if clst is not None:
+            clst = select_splits(batch_info, clst, idx, 1)
+        if batch_info.factorized:
+            plst = select_splits(batch_info, plst, idx, 1)
+
+    if batch_info.factorized:
+        h, c = outside_compose_projected(compose_func, plst, clst)
+    else:
+        h, c = outside_compose(compose_func, hlst, clst)
+
+    p = torch.softmax(s, dim=1)
+    hbar, cbar, sbar = outside_aggregate(batch_info, h, c, s, p, normalize_func)
+    hbar, cbar, sbar = outside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
 
-    outside_fill_chart(batch_info, chart, index, hbar, cbar, sbar)
+
+
+# Constraints
+#
+# Known brackets (e.g. entities) can be given for each sentence as (pos, size). A cell
+# that crosses a bracket is not allowed, and neither is a split (or outside pair) that
+# uses a cell that is not allowed. Only the allowed splits and pairs are gathered,
+# scored and composed, so the cost of a level shrinks with the fraction of crossing
+# splits. The other splits get a score of -BIG in `split_s`, so CKY returns trees that
+# have every bracket. Cells that are not allowed are left as zeros.
+
+def get_bracket_constraints(batch_map, key):
+    """
+    Returns the (pos, size) brackets of each sentence from `batch_map[key]`, which has
+    the gold `spans` as (pos, size) or the `entity_labels` as (label, pos, size).
+
+    """
+    if key is None or key not in batch_map:
+        return None
+    if key == 'entity_labels':
+        return [[(int(el[1]), int(el[2])) for el in lst if el is not None] for lst in batch_map[key]]
+    return [[(int(pos), int(size)) for pos, size in lst] for lst in batch_map[key]]
+
+
+def get_constraint_mask(index, length, nlevels, constraints):
+    """
+    Returns whether each cell crosses none of the brackets of its sentence, as a
+    (batch_size, ncells) tensor. `constraints` has a list of (pos, size) brackets
+    for each sentence.
+
+    """
+    cell_start = index.get_cell_start(length, nlevels).view(1, -1, 1)
+    cell_end = index.get_cell_end(length, nlevels).view(1, -1, 1)
+
+    # Padded with single tokens, which never cross a cell.
+    K = max([1] + [len(lst) for lst in constraints])
+    brackets = np.zeros((len(constraints), K, 2), dtype=np.int64)
+    for i, lst in enumerate(constraints):
+        for j, (pos, size) in enumerate(lst):
+            brackets[i, j] = (pos, pos + size - 1)
+    brackets = torch.from_numpy(brackets).to(cell_end.device)
+    start, end = brackets[:, :, 0].unsqueeze(1), brackets[:, :, 1].unsqueeze(1)
+
+    crosses = ((cell_start < start) & (start <= cell_end) & (cell_end < end)) | \
+              ((start < cell_start) & (cell_start <= end) & (end < cell_end))
+
+    return ~crosses.any(2)
+
+
+def get_split_constraint_mask(allowed, lidx, ridx, offset, L):
+    """
+    Returns whether each (pos, split) of the `L` cells from `offset` is allowed, as a
+    (batch_size, L, N) tensor. `lidx` and `ridx` are the inside index of the cells.
+
+    """
+    B = allowed.shape[0]
+    cell = allowed[:, offset:offset+L].view(B, L, 1)
+    left = allowed.index_select(index=lidx, dim=1).view(B, L, -1)
+    right = allowed.index_select(index=ridx, dim=1).view(B, L, -1)
+    return cell & left & right
+
+
+def get_inside_mask(batch_info, index):
+    if batch_info.constraint is None:
+        return None
+
+    L = batch_info.end - batch_info.start
+    offset = index.get_offset(batch_info.length)[batch_info.level] + batch_info.start
+    lidx, ridx = get_inside_level_index(batch_info, index)
+
+    return get_split_constraint_mask(batch_info.constraint, lidx, ridx, offset, L).unsqueeze(3)
+
+
+def aggregate_selected(batch_info, cells, h, c, s, p, normalize_func):
+    """
+    Same as `inside_aggregate`, but for the selected splits (or pairs) only. `cells` is
+    the (batch, pos) of each one, flattened.
+
+    """
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+
+    def aggregate(x):
+        x = x * p
+        return torch.zeros(B * L, x.shape[1], dtype=x.dtype, device=x.device).index_add(0, cells, x).view(B, L, -1)
+
+    h_agg = normalize_func(aggregate(h))
+    s_agg = aggregate(s)
+
+    c_agg = None
+    if c is not None:
+        c_agg = normalize_func(aggregate(c))
+
+    return h_agg, c_agg, s_agg
+
+
+def inside_compose_selected(compose_func, score_func, batch_info, chart, index, b, pos, split):
+    """
+    Composes and scores the selected (batch, pos, split) triples of this level only.
+    Returns the flat h, c and s of each one.
+
+    """
+    N = batch_info.level
+    dtype = chart.dtype
+
+    lidx, ridx = get_inside_level_index(batch_info, index)
+    lidx, ridx = lidx[pos * N + split], ridx[pos * N + split]
+
+    hlst = [chart.inside_h[b, lidx].to(dtype), chart.inside_h[b, ridx].to(dtype)]
+    slst = [chart.inside_s[b, lidx], chart.inside_s[b, ridx]]
+    clst = None
+    if chart.cell:
+        clst = [chart.inside_c[b, lidx].to(dtype), chart.inside_c[b, ridx].to(dtype)]
+
+    if batch_info.factorized:
+        plst = [chart.inside_lp[b, lidx], chart.inside_rp[b, ridx]]
+        h, c = inside_compose_projected(compose_func, plst, clst)
+        s = score_func.forward_projected(chart.inside_sp[b, lidx], hlst[1]) + slst[0] + slst[1]
+    else:
+        h, c = inside_compose(compose_func, hlst, clst)
+        s = score_func(hlst[0], hlst[1]) + slst[0] + slst[1]
 
     return h, c, s
 
 
+def inside_compute_constrained(compose_func, score_func, batch_info, chart, index, normalize_func):
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+    N = batch_info.level
+
+    mask = get_inside_mask(batch_info, index)
+    b, pos, split, _ = mask.nonzero(as_tuple=True)
+
+    h, c, s = inside_compose_selected(compose_func, score_func, batch_info, chart, index, b, pos, split)
+
+    s = torch.full((B, L, N, 1), -BIG, dtype=s.dtype, device=s.device).index_put((b, pos, split), s)
+    p = torch.softmax(s, dim=2)
+
+    hbar, cbar, sbar = aggregate_selected(batch_info, b * L + pos, h, c, s[b, pos, split],
+        p[b, pos, split], normalize_func)
+    hbar, cbar, sbar = inside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
+
+
+def outside_compute_constrained(compose_func, score_func, batch_info, chart, index, normalize_func):
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+    dtype = chart.dtype
+
+    pidx, sidx = get_outside_level_index(batch_info, index)
+    M = pidx.shape[0] // L
+
+    mask = get_outside_mask(batch_info, index)
+    b, pair, pos, _ = mask.expand(B, M, L, 1).nonzero(as_tuple=True)
+    pidx, sidx = pidx[pair * L + pos], sidx[pair * L + pos]
+
+    hlst = [chart.inside_h[b, sidx].to(dtype), chart.outside_h[b, pidx].to(dtype)]
+    slst = [chart.inside_s[b, sidx], chart.outside_s[b, pidx]]
+    clst = None
+    if chart.cell:
+        clst = [chart.inside_c[b, sidx].to(dtype), chart.outside_c[b, pidx].to(dtype)]
+
+    if batch_info.factorized:
+        plst = [chart.outside_lp[b, sidx], chart.outside_rp[b, pidx]]
+        h, c = outside_compose_projected(compose_func, plst, clst)
+        s = score_func.forward_projected(chart.outside_sp[b, sidx], hlst[1]) + slst[0] + slst[1]
+    else:
+        h, c = outside_compose(compose_func, hlst, clst)
+        s = score_func(hlst[0], hlst[1]) + slst[0] + slst[1]
+
+    s = torch.full((B, M, L, 1), -BIG, dtype=s.dtype, device=s.device).index_put((b, pair, pos), s)
+    p = torch.softmax(s, dim=1)
+
+    hbar, cbar, sbar = aggregate_selected(batch_info, b * L + pos, h, c, s[b, pair, pos],
+        p[b, pair, pos], normalize_func)
+    hbar, cbar, sbar = outside_mask(batch_info, index, hbar, cbar, sbar)
+
+    return h, c, s, hbar, cbar, sbar
+
+
+# Memoization
+#
+# At inference, a cell only depends on the tokens of its span, so the cells of a level
+# are keyed by a hash of their tokens (see diora.net.span_memo). Each distinct span
+# that is not in the memo is composed once, and its (h, c, s) and split scores are
+# copied into every cell that has it.
+
+def inside_compute_memo(compose_func, score_func, batch_info, chart, index, normalize_func):
+    B = batch_info.batch_size
+    L = batch_info.end - batch_info.start
+    N = batch_info.level
+    memo = batch_info.memo
+    level = batch_info.level
+
+    # Cells are deduplicated by their token ids, and looked up by their hash.
+    spans, valid = memo.get_spans(batch_info)
+    cells = valid.view(-1).nonzero().squeeze(1)
+    spans, inverse = torch.unique(spans.view(B * L, -1)[cells], dim=0, return_inverse=True)
+    keys = memo.get_keys(spans)
+    rows, found = memo.lookup(level, keys, spans)
+    values = memo.get(level, rows) if found.any() else None
+
+    # The first cell of each new span.
+    new = (~found).nonzero().squeeze(1)
+    first = torch.full_like(keys, B * L).scatter_reduce(0, inverse, cells, 'amin')[new]
+    M = new.shape[0]
+
+    if M > 0:
+        b = first.div(L, rounding_mode='floor').repeat_interleave(N)
+        pos = (first % L).repeat_interleave(N)
+        split = torch.arange(N, device=b.device).repeat(M)
+
+        h, c, s = inside_compose_selected(compose_func, score_func, batch_info, chart, index, b, pos, split)
+
+        s = s.view(M, N, 1)
+        p = torch.softmax(s, dim=1)
+        new_values = {}
+        new_values['h'] = normalize_func(torch.sum(h.view(M, N, -1) * p, 1))
+        if c is not None:
+            new_values['c'] = normalize_func(torch.sum(c.view(M, N, -1) * p, 1))
+        new_values['sbar'] = torch.sum(s * p, 1)
+        new_values['s'] = s
+        memo.put(level, keys[new], spans[new], new_values)
+
+        if values is None:
+            values = new_values
+        else:
+            for k, v in new_values.items():
+                values[k][new] = v
+
+    memo.cells += cells.shape[0]
+    memo.computed += M
+
+    # Cells past the end of a sentence are zeros.
+    def scatter(x):
+        out = torch.zeros((B * L,) + x.shape[1:], dtype=x.dtype, device=x.device)
+        out[cells] = x[inverse]
+        return out.view((B, L) + x.shape[1:])
+
+    hbar, sbar, s = scatter(values['h']), scatter(values['sbar']), scatter(values['s'])
+    cbar = scatter(values['c']) if 'c' in values else None
+
+    return None, None, s, hbar, cbar, sbar
+
+
 # Base
 
 class DioraBase(nn.Module):
@@ -356,7 +1447,15 @@ class DioraBase(nn.Module):
 
     """
 
-    def __init__(self, size, outside=True, normalize='unit', compress=False):
+    # Whether the compose function has a cell state (c) that is stored in the chart.
+    has_cell = True
+
+    # About how many D-sized float tensors backward keeps for each (cell, split) pair.
+    # Used to estimate the memory of a level when checkpointing by budget.
+    split_memory = 16
+
+    def __init__(self, size, outside=True, normalize='unit', compress=False, factorized=False,
+                 fused=False):
         super(DioraBase, self).__init__()
         assert normalize in ('none', 'unit'), 'Does not support "{}".'.format(normalize)
 
@@ -365,9 +1464,35 @@ class DioraBase(nn.Module):
         self.inside_normalize_func = NormalizeFunc(normalize)
         self.outside_normalize_func = NormalizeFunc(normalize)
         self.compress = compress
+        self.factorized = factorized
+        self.fused = fused
         self.ninput = 2
 
         self.index = None
+        self.index_table = None
+        self.arena = None
+        self.chart = None
+
+        # Gradient checkpointing (see `get_checkpoint_levels`).
+        self.checkpoint_every = None
+        self.checkpoint_budget = None
+        self.checkpoint_levels = (set(), set())
+
+        # Chunked levels (see `get_level_chunks`).
+        self.chunk_budget = None
+
+        # Compiled level functions (see diora.net.compiled).
+        self.compiled = False
+
+        # Lower precision h and c in the chart, for inference (see `Chart`).
+        self.storage_dtype = None
+
+        # If set, then only the top-k splits of each cell are composed (see "Pruning").
+        self.topk = None
+
+        # If set, then the chart only has the spans of up to this many tokens (see
+        # `get_num_levels`).
+        self.max_span_width = None
 
         self.init_parameters()
         self.reset_parameters()
@@ -385,25 +1510,35 @@ class DioraBase(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    @property
+    def dtype(self):
+        return next(self.parameters()).dtype
+
+    # The h and c properties are upcast if the chart stores them in lower precision.
+
     @property
     def inside_h(self):
-        return self.chart.inside_h
+        return upcast(self.chart.inside_h, self.chart.dtype)
 
     @property
     def inside_c(self):
-        return self.chart.inside_c
+        return upcast(self.chart.inside_c, self.chart.dtype)
 
     @property
     def inside_s(self):
         return self.chart.inside_s
 
+    @property
+    def split_s(self):
+        return self.chart.split_s
+
     @property
     def outside_h(self):
-        return self.chart.outside_h
+        return upcast(self.chart.outside_h, self.chart.dtype)
 
     @property
     def outside_c(self):
-        return self.chart.outside_c
+        return upcast(self.chart.outside_c, self.chart.dtype)
 
     @property
     def outside_s(self):
@@ -432,47 +1567,258 @@ class DioraBase(nn.Module):
         input_shape = x.shape[:-1]
         h, c = transform_func(x)
         h = normalize_func(h.view(*input_shape, self.size))
-        c = normalize_func(c.view(*input_shape, self.size))
+        if c is not None:
+            c = normalize_func(c.view(*input_shape, self.size))
 
         return h, c
 
-    def inside_pass(self):
+    def inside_pass(self, batch_info_cache=None, span_memo=None):
+        """
+        Fills the inside chart one level at a time. With a `span_memo` (see
+        diora.net.span_memo), the cells of the spans it has seen are not composed again.
+
+        """
         compose_func = self.inside_compose_func
         score_func = self.inside_score_func
         index = self.index
         chart = self.chart
         normalize_func = self.inside_normalize_func
 
-        for level in range(1, self.length):
+        for level in range(1, self.nlevels):
+            slst = []
 
-            batch_info = BatchInfo(
-                batch_size=self.batch_size,
-                length=self.length,
-                size=self.size,
-                level=level,
-                )
+            for batch_info in self.get_batch_infos(level, cache=batch_info_cache, memo=span_memo):
+                h, c, s = inside_func(compose_func, score_func, batch_info, chart, index,
+                    normalize_func=normalize_func)
+                slst.append(s)
 
-            h, c, s = inside_func(compose_func, score_func, batch_info, chart, index,
-                normalize_func=normalize_func)
+            # Only the split scores are kept across chunks.
+            if len(slst) > 1:
+                h, c, s = None, None, torch.cat(slst, 1)
 
-            # Save the scalars.
+            # Save the scalars. After `extend`, only the new cells were computed.
             length = self.length
             B = self.batch_size
-            L = length - level
+            start = self.get_level_start(level)
+            L = length - level - start
+            N = level
 
             assert s.shape[0] == B
             assert s.shape[1] == L
-            # assert s.shape[2] == N
+            assert s.shape[2] == N
             assert s.shape[3] == 1
             assert len(s.shape) == 4
             smax = s.max(2, keepdim=True)[0]
             s = s - smax
 
-            for pos in range(L):
-                self.saved_scalars[level][pos] = s[:, pos, :]
+            offset = index.get_offset(length)[level] + start
+            chart.split_s[:, offset:offset+L, :N] = s.view(B, L, N)
 
             self.inside_hook(level, h, c, s)
 
+        # A dense (B, L, N) view per level. The split scores of span (level, pos)
+        # are saved_scalars[level][:, pos].
+        for level in range(1, self.nlevels):
+            self.saved_scalars[level] = self.get_split_scores(level)
+
+    def get_split_scores(self, level):
+        L = self.length - level
+        N = level
+        offset = self.index.get_offset(self.length)[level]
+        return self.chart.split_s[:, offset:offset+L, :N]
+
+    def get_num_levels(self, length):
+        """
+        Returns the number of chart levels for sentences with `length` tokens.
+
+        With `max_span_width` W and longer inputs, the chart is windowed: it only has the
+        spans of up to W tokens, so it has O(n * W) cells and the inside and outside
+        passes do O(n * W^2) compositions. Each cell at the top level (W tokens) is
+        treated as a root by the outside pass. CKY then finds the best tree of each
+        W-token chunk, and joins the chunks right-branching (see `ParsePredictor`).
+
+        """
+        if self.max_span_width is None:
+            return length
+        return min(length, self.max_span_width)
+
+    def get_level_memory(self, level, outside=False):
+        """
+        Estimates the bytes that backward keeps for a level when it is not checkpointed.
+
+        """
+        L = self.length - level
+        N = level
+        if outside and self.nlevels < self.length:
+            N = 2 * (self.nlevels - level - 1)
+        elif outside:
+            N = self.length - level - 1
+        return self.batch_size * L * N * self.size * 4 * self.split_memory
+
+    def get_batch_infos(self, level, outside=False, cache=None, memo=None):
+        """
+        Returns a BatchInfo for each chunk of a level.
+
+        With a `cache` (a dict), the BatchInfo objects are built once per batch size,
+        length and level, and only their per-batch fields are set afterwards. The cache
+        must be cleared if the chunking or checkpointing config changes.
+
+        """
+        key = (self.batch_size, self.length, level, outside, self.prefix_length)
+
+        if cache is not None and key in cache:
+            batch_infos = cache[key]
+        else:
+            checkpoint = level in self.checkpoint_levels[1 if outside else 0]
+            batch_infos = [BatchInfo(
+                batch_size=self.batch_size,
+                length=self.length,
+                size=self.size,
+                level=level,
+                start=start,
+                end=end,
+                factorized=self.factorized,
+                checkpoint=checkpoint,
+                ) for start, end in self.get_level_chunks(level, outside=outside)]
+            if cache is not None:
+                cache[key] = batch_infos
+
+        for batch_info in batch_infos:
+            batch_info.compiled = self.compiled
+            batch_info.topk = self.topk
+            batch_info.nlevels = self.nlevels
+            batch_info.constraint = self.constraint_mask
+            batch_info.lengths = self.lengths
+            batch_info.mask = self.mask
+            batch_info.memo = memo
+            batch_info.target_mask = None
+            if outside:
+                batch_info.root = self.outside_root
+                batch_info.target_mask = self.outside_target_mask
+
+        return batch_infos
+
+    def get_outside_ranges(self, batch_index, positions, sizes):
+        """
+        Returns the ranges of positions [start, end) of each level that have a cell that
+        contains one of the spans (batch_index, position, size) in some sentence of the
+        batch. A cell's outside only reads the outside of its parents (and the inside of
+        its siblings), and the parents of a cell that contains a span contain it too. So
+        these cells are all that the outside of the spans needs.
+
+        """
+        # No spans, so no cells are needed.
+        if len(sizes) == 0:
+            return {level: [] for level in range(self.nlevels)}
+
+        lengths = self.lengths.tolist() if self.lengths is not None else [self.length] * self.batch_size
+
+        assert max(sizes) <= self.nlevels, 'Spans wider than `max_span_width` are not in the chart.'
+
+        intervals = {level: [] for level in range(self.nlevels)}
+        for i, pos, size in zip(batch_index, positions, sizes):
+            n = lengths[i]
+            for level in range(size - 1, min(n, self.nlevels)):
+                start = max(0, pos + size - 1 - level)
+                end = min(pos, n - 1 - level) + 1
+                intervals[level].append((start, end))
+
+        ranges = {}
+        for level, lst in intervals.items():
+            merged = []
+            for start, end in sorted(lst):
+                if len(merged) > 0 and start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            ranges[level] = merged
+
+        return ranges
+
+    def get_outside_target_mask(self, batch_index, positions, sizes):
+        """
+        Returns whether each cell contains one of the spans of its own sentence, as a
+        (batch_size, ncells) tensor. Within the ranges of `get_outside_ranges`, only the
+        pairs of these cells are composed (see `get_outside_mask`).
+
+        """
+        cell_start = self.index.get_cell_start(self.length, self.nlevels).view(1, -1)
+        cell_end = self.index.get_cell_end(self.length, self.nlevels).view(1, -1)
+        device = cell_end.device
+        b = torch.tensor(batch_index, dtype=torch.int64, device=device)
+        pos = torch.tensor(positions, dtype=torch.int64, device=device).view(-1, 1)
+        end = pos + torch.tensor(sizes, dtype=torch.int64, device=device).view(-1, 1) - 1
+        contains = ((cell_start <= pos) & (cell_end >= end)).to(torch.int64)
+        mask = torch.zeros(self.batch_size, contains.shape[1], dtype=torch.int64, device=device)
+        return mask.index_add(0, b, contains) > 0
+
+    def get_level_start(self, level):
+        """
+        Returns the first position of a level that the inside pass computes. After
+        `extend`, the cells that end before `prefix_length` are already in the chart.
+
+        """
+        return max(0, self.prefix_length - level)
+
+    def get_level_chunks(self, level, outside=False):
+        """
+        Returns the ranges of positions [start, end) that a level is computed in. If
+        `chunk_budget` is set (in bytes), then each chunk is sized so that the estimated
+        memory of its compose and score intermediates fits in the budget, and the chart
+        is filled one chunk at a time. A targeted outside pass only computes the ranges
+        of `outside_ranges`.
+
+        """
+        L = self.length - level
+        ranges = [(0 if outside else self.get_level_start(level), L)]
+        if outside and self.outside_ranges is not None:
+            ranges = self.outside_ranges[level]
+        if self.chunk_budget is None:
+            return ranges
+        per_position = max(1, self.get_level_memory(level, outside) // L)
+        size = max(1, self.chunk_budget // per_position)
+        return [(start, min(start + size, end)) for first, end in ranges for start in range(first, end, size)]
+
+    def get_checkpoint_levels(self):
+        """
+        Returns the sets of inside and outside levels to checkpoint. A checkpointed level
+        keeps only its chart cells for backward, and its compose and score intermediates
+        are recomputed.
+
+        If `checkpoint_every` is k, then every k-th level is checkpointed. If
+        `checkpoint_budget` is set (in bytes), then the largest levels are checkpointed
+        until the estimated memory of the others fits in the budget.
+
+        """
+        inside_levels, outside_levels = set(), set()
+
+        if not torch.is_grad_enabled():
+            return inside_levels, outside_levels
+
+        levels = [(level, False) for level in range(1, self.nlevels)]
+        if self.chart.outside_h is not None:
+            levels += [(level, True) for level in range(self.nlevels - 1)]
+
+        selected = []
+        if self.checkpoint_every is not None:
+            selected = [x for x in levels if x[0] % self.checkpoint_every == 0]
+        if self.checkpoint_budget is not None:
+            levels = sorted(levels, key=lambda x: self.get_level_memory(*x), reverse=True)
+            total = sum(self.get_level_memory(*x) for x in levels)
+            for x in levels:
+                if total <= self.checkpoint_budget:
+                    break
+                selected.append(x)
+                total -= self.get_level_memory(*x)
+
+        for level, outside in selected:
+            if outside:
+                outside_levels.add(level)
+            else:
+                inside_levels.add(level)
+
+        return inside_levels, outside_levels
+
     def inside_hook(self, level, h, c, s):
         pass
 
@@ -484,23 +1830,79 @@ class DioraBase(nn.Module):
         D = self.size
         normalize_func = self.outside_normalize_func
 
-        if self.compress:
-            h = torch.matmul(self.inside_h[:, -1:], self.root_mat_out)
+        # The top level. In a windowed chart, every cell at the top level is a root.
+        level = self.nlevels - 1
+        L = self.length - level
+        offset = self.index.get_offset(self.length)[level]
+
+        if self.compress and self.lengths is not None:
+            root_offset = self.index.get_offset(self.length)
+            root_index = torch.tensor([root_offset[n - 1] for n in self.lengths.tolist()],
+                dtype=torch.int64, device=self.chart.inside_h.device)
+            inside_root = self.chart.inside_h[torch.arange(B, device=root_index.device), root_index]
+            h = torch.matmul(inside_root.unsqueeze(1).to(self.chart.dtype), self.root_mat_out)
+        elif self.compress:
+            h = torch.matmul(self.chart.inside_h[:, -1:].to(self.chart.dtype), self.root_mat_out)
         else:
             h = self.root_vector_out_h.view(1, 1, D).expand(B, 1, D)
-        if self.root_vector_out_c is None:
-            device = torch.cuda.current_device() if self.is_cuda else None
-            c = torch.full(h.shape, 0, dtype=torch.float32, device=device)
-        else:
+        h = normalize_func(h)
+
+        c = None
+        if self.has_cell:
             c = self.root_vector_out_c.view(1, 1, D).expand(B, 1, D)
+            c = normalize_func(c)
 
-        h = normalize_func(h)
-        c = normalize_func(c)
+        # Shorter sentences in a packed batch have their root set during the outside pass.
+        self.outside_root = (h, c)
+        h = h.expand(B, L, D)
+        if c is not None:
+            c = c.expand(B, L, D)
+        if self.mask is not None:
+            mask = self.mask[:, offset:offset+L].unsqueeze(2).to(h.dtype)
+            h = h * mask
+            if c is not None:
+                c = c * mask
+
+        self.chart.fill(True, offset, h, c)
 
-        self.chart.outside_h[:, -1:] = h
-        self.chart.outside_c[:, -1:] = c
+        if self.factorized:
+            outside_fill_projections(self.outside_compose_func, self.chart, offset, h)
+
+    def initialize_outside_projections(self):
+        compose_func = self.outside_compose_func
+        score_func = self.outside_score_func
+
+        # Every inside cell is a sibling in the outside pass, so project them all at once.
+        if compose_func is self.inside_compose_func:
+            self.chart.outside_lp = self.chart.inside_lp
+        else:
+            self.chart.outside_lp = compose_func.project(self.inside_h, 0)
+
+        if score_func is self.inside_score_func:
+            self.chart.outside_sp = self.chart.inside_sp
+        else:
+            self.chart.outside_sp = score_func.project(self.inside_h)
+
+    def outside_pass(self, batch_info_cache=None, targets=None):
+        """
+        Fills the outside chart one level at a time, from the top. If `targets` is set,
+        then it is the (batch_index, positions, sizes) of some spans, and only the cells
+        that contain one of them in their sentence are computed: the levels are
+        computed in the ranges of `get_outside_ranges`, and only the pairs of the cells
+        in `get_outside_target_mask` are composed. The outside cells of the targets are
+        the same as after a full pass, but the other cells are not valid.
+
+        """
+        self.outside_ranges = None
+        self.outside_target_mask = None
+        if targets is not None:
+            self.outside_ranges = self.get_outside_ranges(*targets)
+            self.outside_target_mask = self.get_outside_target_mask(*targets)
+            batch_info_cache = None
+
+        if self.factorized:
+            self.initialize_outside_projections()
 
-    def outside_pass(self):
         self.initialize_outside_root()
 
         compose_func = self.outside_compose_func
@@ -509,49 +1911,165 @@ class DioraBase(nn.Module):
         chart = self.chart
         normalize_func = self.outside_normalize_func
 
-        for level in range(self.length - 2, -1, -1):
-            batch_info = BatchInfo(
-                batch_size=self.batch_size,
-                length=self.length,
-                size=self.size,
-                level=level,
-                )
+        for level in range(self.nlevels - 2, -1, -1):
+            slst = []
+
+            for batch_info in self.get_batch_infos(level, outside=True, cache=batch_info_cache):
+                h, c, s = outside_func(compose_func, score_func, batch_info, chart, index,
+                    normalize_func=normalize_func)
+                slst.append(s)
+
+            # No target is this short.
+            if len(slst) == 0:
+                continue
 
-            h, c, s = outside_func(compose_func, score_func, batch_info, chart, index,
-                normalize_func=normalize_func)
+            # Only the scores are kept across chunks.
+            if len(slst) > 1:
+                h, c, s = None, None, torch.cat(slst, 2)
 
             self.outside_hook(level, h, c, s)
 
-    def init_with_batch(self, h, c):
+    def targeted_outside_pass(self, batch_index, positions, sizes):
+        """
+        Runs the outside pass for the spans (batch_index, position, size) only, after the
+        inside pass, and returns their outside h with one row per span. The chart must
+        have outside cells.
+
+        """
+        assert self.chart.outside_h is not None, 'The chart has no outside cells.'
+
+        self.outside_pass(targets=(batch_index, positions, sizes))
+
+        offset = self.index.get_offset(self.length)
+        idx = [offset[size - 1] + pos for pos, size in zip(positions, sizes)]
+
+        return self.chart.outside_h[batch_index, idx].to(self.chart.dtype)
+
+    def init_with_batch(self, h, c, lengths=None, outside=None, arena=None, constraints=None):
+        """
+        Sets up the chart for a batch. `outside` and `arena` override the model's
+        settings for this batch only. See `forward` for `constraints`.
+
+        """
+        outside = self.outside if outside is None else outside
+        arena = self.arena if arena is None else arena
+
         size = self.size
         batch_size, length, _ = h.shape
 
         self.batch_size = batch_size
         self.length = length
+        self.nlevels = self.get_num_levels(length)
+        self.prefix_length = 0
+        self.lengths = lengths
+        self.mask = None
+        self.constraint_mask = None
+
+        if self.nlevels < length:
+            assert not self.compress, 'A windowed chart has no single root to compress.'
+            assert self.topk is None, 'Pruning is not supported with a windowed chart.'
+
+        # Packed batch. Cells past the end of a sentence are masked.
+        if lengths is not None:
+            cell_end = self.index.get_cell_end(length, self.nlevels)
+            self.mask = cell_end.view(1, -1) < lengths.view(-1, 1)
+            mask = self.mask[:, :length].unsqueeze(2).to(h.dtype)
+            h = h * mask
+            if c is not None:
+                c = c * mask
+
+        if constraints is not None and any(len(lst) > 0 for lst in constraints):
+            self.constraint_mask = get_constraint_mask(self.index, length, self.nlevels, constraints)
+
+        projection_size = self.inside_compose_func.projection_size if self.factorized else None
+
+        # Lower precision storage is only used without gradients.
+        storage_dtype = None if torch.is_grad_enabled() else self.storage_dtype
+
+        self.chart = Chart(batch_size, length, size, dtype=self.dtype, cuda=self.is_cuda,
+            projection_size=projection_size, arena=arena, outside=outside,
+            fused=self.fused, cell=self.has_cell, storage_dtype=storage_dtype, nlevels=self.nlevels)
+        self.chart.fill(False, 0, h, c)
+
+        if self.factorized:
+            inside_fill_projections(self.inside_compose_func, self.inside_score_func, self.chart, 0, h)
+
+        self.saved_scalars = {}
+        self.checkpoint_levels = self.get_checkpoint_levels()
+
+    def init_with_cache(self, chart, lengths=None):
+        """
+        Sets a chart that was read from a `ChartCache` (see diora.net.chart_cache) rather
+        than computed. It only has the cells that the losses and CKY read.
+
+        """
+        if self.index is None:
+            self.index = Index(cuda=self.is_cuda, table=self.index_table)
+
+        self.reset()
 
-        self.chart = Chart(batch_size, length, size, dtype=torch.float32, cuda=self.is_cuda)
-        self.chart.inside_h[:, :self.length] = h
-        self.chart.inside_c[:, :self.length] = c
+        self.batch_size, self.length, _ = chart.outside_h.shape
+        self.nlevels = self.get_num_levels(self.length)
+        self.lengths = lengths
+        self.chart = chart
 
-        self.saved_scalars = {i: {} for i in range(self.length)}
+        self.saved_scalars = {}
+        for level in range(1, self.nlevels):
+            self.saved_scalars[level] = self.get_split_scores(level)
+
+    def release_chart(self):
+        """
+        Returns the chart's buffers to the arena (if any). Must only be called once
+        nothing will read the chart again, and after backward when training.
+
+        """
+        if self.chart is not None:
+            self.chart.release()
 
     def reset(self):
+        # Without gradients, nothing can depend on the previous chart after this point.
+        if self.chart is not None and not self.chart.grad_enabled:
+            self.release_chart()
+
         self.batch_size = None
         self.length = None
+        self.nlevels = None
+        self.prefix_length = 0
+        self.lengths = None
+        self.mask = None
+        self.constraint_mask = None
+        self.outside_root = None
+        self.outside_ranges = None
+        self.outside_target_mask = None
         self.chart = None
 
     def get_chart_wrapper(self):
         return self
 
-    def forward(self, x):
+    def forward(self, x, lengths=None, leaves=None, constraints=None):
+        """
+        If `lengths` is set, then `x` is a packed batch of right-padded sentences with
+        the given number of tokens, and each sentence's chart is computed as if it had
+        been run on its own.
+
+        If `leaves` is set, then it is the (h, c) of the leaves (already transformed and
+        normalized) and `x` is ignored.
+
+        If `constraints` is set, then it is a list of (pos, size) brackets for each
+        sentence, and the splits that cross them are skipped (see "Constraints").
+
+        """
         if self.index is None:
-            self.index = Index(cuda=self.is_cuda)
+            self.index = Index(cuda=self.is_cuda, table=self.index_table)
 
         self.reset()
 
-        h, c = self.leaf_transform(x)
+        if leaves is None:
+            h, c = self.leaf_transform(x)
+        else:
+            h, c = leaves
 
-        self.init_with_batch(h, c)
+        self.init_with_batch(h, c, lengths=lengths, constraints=constraints)
 
         self.inside_pass()
 
@@ -560,6 +2078,69 @@ class DioraBase(nn.Module):
 
         return None
 
+    def extend(self, x, leaves=None, arena=None, batch_info_cache=None, span_memo=None):
+        """
+        Appends the tokens `x` (or their `leaves`, see `forward`) to the sentences of the
+        last batch, and extends its inside chart. The cells of spans that end before the
+        new tokens do not change, so they are copied, and only the new cells are
+        computed: O(n^2 k) compositions for k new tokens rather than O((n + k)^3). The
+        outside pass is not run.
+
+        Not supported for packed batches or with constraints. See `inside_pass` for
+        `span_memo`.
+
+        """
+        assert self.chart is not None, 'There is no chart to extend.'
+        assert self.lengths is None and self.constraint_mask is None, \
+            'Can not extend a packed or constrained batch.'
+
+        if leaves is None:
+            h, c = self.leaf_transform(x)
+        else:
+            h, c = leaves
+
+        old_chart, old_length, old_nlevels = self.chart, self.length, self.nlevels
+
+        length = old_length + h.shape[1]
+        self.length = length
+        self.nlevels = self.get_num_levels(length)
+        self.prefix_length = old_length
+
+        projection_size = self.inside_compose_func.projection_size if self.factorized else None
+        storage_dtype = None if torch.is_grad_enabled() else self.storage_dtype
+
+        self.chart = Chart(self.batch_size, length, self.size, dtype=self.dtype, cuda=self.is_cuda,
+            projection_size=projection_size, arena=arena, outside=False,
+            fused=self.fused, cell=self.has_cell, storage_dtype=storage_dtype, nlevels=self.nlevels)
+
+        # Copy the cells of the prefix. The offsets of each level change with the length.
+        names = ['inside_hcs'] if self.fused else ['inside_h', 'inside_c', 'inside_s']
+        names += ['split_s', 'inside_lp', 'inside_rp', 'inside_sp']
+        old_offset = self.index.get_offset(old_length)
+        offset = self.index.get_offset(length)
+        for name in names:
+            src, dst = getattr(old_chart, name), getattr(self.chart, name)
+            if src is None:
+                continue
+            for level in range(min(old_nlevels, self.nlevels)):
+                L = old_length - level
+                dst[:, offset[level]:offset[level]+L, :src.shape[2]] = src[:, old_offset[level]:old_offset[level]+L]
+
+        if not old_chart.grad_enabled:
+            old_chart.release()
+
+        self.chart.fill(False, old_length, h, c)
+
+        if self.factorized:
+            inside_fill_projections(self.inside_compose_func, self.inside_score_func, self.chart, old_length, h)
+
+        self.saved_scalars = {}
+        self.checkpoint_levels = self.get_checkpoint_levels()
+
+        self.inside_pass(batch_info_cache=batch_info_cache, span_memo=span_memo)
+
+        return None
+
 
 class DioraTreeLSTM(DioraBase):
     r"""DioraTreeLSTM
@@ -583,6 +2164,9 @@ class DioraTreeLSTM(DioraBase):
 
 class DioraMLP(DioraBase):
 
+    has_cell = False
+    split_memory = 8
+
     def init_parameters(self):
         self.inside_score_func = Bilinear(self.size)
         self.outside_score_func = Bilinear(self.size)
@@ -599,6 +2183,9 @@ class DioraMLP(DioraBase):
 
 class DioraMLPShared(DioraBase):
 
+    has_cell = False
+    split_memory = 8
+
     def init_parameters(self):
         self.inside_score_func = Bilinear(self.size)
         self.outside_score_func = self.inside_score_func
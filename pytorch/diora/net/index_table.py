@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+
+from diora.net.inside_index import get_inside_index_np
+from diora.net.outside_index import get_outside_index_np
+from diora.utils.fs import mkdir_p
+
+
+class IndexTable(object):
+    r"""IndexTable
+
+    The inside and outside gather indices for every (length, level) up to
+    `max_length`, stored in one flat array. The table is saved to a cache file
+    once and then memory-mapped read-only, so every process on a machine shares
+    the same pages instead of building its own copy.
+
+    """
+
+    def __init__(self, data, max_length):
+        super(IndexTable, self).__init__()
+        self.data = data
+        self.max_length = max_length
+        self.pointers, _ = self.layout(max_length)
+
+    @staticmethod
+    def layout(max_length):
+        """
+        Returns {(kind, length, level): (start, size)} and the total size. Each entry
+        holds two arrays of `size` indices back to back.
+
+        """
+        pointers = {}
+        total = 0
+        for length in range(1, max_length + 1):
+            for level in range(1, length):
+                size = (length - level) * level
+                pointers[('inside', length, level)] = (total, size)
+                total += 2 * size
+            for level in range(0, length - 1):
+                size = (length - level) * (length - level - 1)
+                pointers[('outside', length, level)] = (total, size)
+                total += 2 * size
+        return pointers, total
+
+    @staticmethod
+    def get_dtype(max_length):
+        ncells = max_length * (max_length + 1) // 2
+        return np.int16 if ncells <= np.iinfo(np.int16).max else np.int32
+
+    @classmethod
+    def build(cls, max_length):
+        pointers, total = cls.layout(max_length)
+        data = np.empty(total, dtype=cls.get_dtype(max_length))
+
+        for (kind, length, level), (start, size) in pointers.items():
+            if kind == 'inside':
+                idx_0, idx_1 = get_inside_index_np(length, level)
+            else:
+                idx_0, idx_1 = get_outside_index_np(length, level)
+            data[start:start+size] = idx_0
+            data[start+size:start+2*size] = idx_1
+
+        return cls(data, max_length)
+
+    @staticmethod
+    def get_path(cache_dir, max_length):
+        return os.path.join(cache_dir, 'index_table.{}.npy'.format(max_length))
+
+    def save(self, path):
+        # Write to a temporary file first, since other processes may be reading the same path.
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp_path, self.data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_length):
+        data = np.load(path, mmap_mode='r')
+        _, total = cls.layout(max_length)
+        assert data.shape == (total,), 'Index table {} is corrupt.'.format(path)
+        return cls(data, max_length)
+
+    @classmethod
+    def load_or_build(cls, cache_dir, max_length):
+        path = cls.get_path(cache_dir, max_length)
+        if not os.path.exists(path):
+            mkdir_p(cache_dir)
+            cls.build(max_length).save(path)
+        return cls.load(path, max_length)
+
+    def get(self, kind, length, level):
+        start, size = self.pointers[(kind, length, level)]
+        return self.data[start:start+size], self.data[start+size:start+2*size]
+
+    def has(self, length):
+        return length <= self.max_length
@@ -0,0 +1,251 @@
+import numpy as np
+import torch
+
+from diora.data.reading import tree_to_spans
+from diora.net.chart_arena import ChartArena
+from diora.net.diora import Index
+from diora.analysis.cky import ParsePredictor
+
+
+class DioraInference(object):
+    r"""DioraInference
+
+    Runs a trained DIORA for inference only. Compared to `Trainer.step`:
+
+    - Everything runs under `torch.inference_mode`, and no loss or result dict is built.
+    - Chart buffers come from the engine's own arena, so the levels are filled in place
+      into buffers that are reused across batches.
+    - The per-level BatchInfo objects are built once per (batch size, length).
+    - `parse` only runs the inside pass, and `span_vectors` only returns the requested
+      cells.
+    - With a `cache` (see diora.net.parse_cache), every parsed sentence is stored, and
+      `parse_sentences` only parses the distinct sentences that are not in the cache.
+    - With a `span_memo` (see diora.net.span_memo), spans that are in several sentences
+      (or batches) are only composed once by the inside pass.
+
+    The chart of the last batch stays in `diora.chart` until the next call. Its tensors
+    are inference tensors, so they can be read but not used for training.
+
+    """
+
+    def __init__(self, diora, embed=None, leaf_table=None, arena=None):
+        super(DioraInference, self).__init__()
+        self.diora = diora
+        self.embed = embed
+        self.leaf_table = leaf_table
+        # Inference tensors can not be recycled into training charts, so use a separate arena.
+        self.arena = ChartArena() if arena is None else arena
+        self.batch_info_cache = {}
+        self.index_lengths = set()
+        self.parse_predictor = ParsePredictor(diora, word2idx={})
+        # The tokens of the last batch, including the tokens added by `extend`.
+        self.batch = None
+        self.cache = None
+        self.span_memo = None
+
+    @classmethod
+    def from_net(cls, net, **kwargs):
+        """
+        Builds an engine that takes token ids, using the embeddings (or leaf table) of `net`.
+
+        """
+        return cls(net.diora, embed=net.embed, leaf_table=net.leaf_table, **kwargs)
+
+    def prepare_index(self, length):
+        # The index tensors are cached on the model, so build them outside of inference
+        # mode. Otherwise they could not be used by a later training step.
+        diora = self.diora
+        if diora.index is None:
+            diora.index = Index(cuda=diora.is_cuda, table=diora.index_table)
+        nlevels = diora.get_num_levels(length)
+        if (length, nlevels) in self.index_lengths:
+            return
+        index = diora.index
+        index.get_cell_start(length, nlevels)
+        index.get_cell_end(length, nlevels)
+        for level in range(1, nlevels):
+            index.get_inside_index(length, level)
+        for level in range(nlevels - 1):
+            if nlevels < length:
+                index.get_window_outside_index(length, level, nlevels)
+                continue
+            index.get_outside_index(length, level)
+            index.get_outside_split_index(length, level)
+        self.index_lengths.add((length, nlevels))
+
+    def get_leaves(self, batch):
+        if self.leaf_table is not None:
+            return self.leaf_table(batch)
+        x = batch if self.embed is None else self.embed(batch)
+        return self.diora.leaf_transform(x)
+
+    def run(self, batch, lengths=None, outside=True, constraints=None, targets=None):
+        """
+        Fills the chart for a batch of token ids (or embeddings, without `embed`) and
+        returns it. `constraints` are the (pos, size) brackets of each sentence (see
+        `DioraBase.forward`). If `targets` is set, then only the outside cells of these
+        (batch_index, positions, sizes) spans are valid (see `DioraBase.outside_pass`).
+
+        """
+        diora = self.diora
+
+        self.prepare_index(batch.shape[1])
+        self.batch = batch
+        if self.span_memo is not None:
+            self.span_memo.set_batch(batch, lengths)
+
+        with torch.inference_mode():
+            diora.reset()
+            h, c = self.get_leaves(batch)
+            diora.init_with_batch(h, c, lengths=lengths, outside=outside, arena=self.arena,
+                constraints=constraints)
+            diora.inside_pass(batch_info_cache=self.batch_info_cache, span_memo=self.span_memo)
+            if outside:
+                diora.outside_pass(batch_info_cache=self.batch_info_cache, targets=targets)
+
+        return diora.chart
+
+    def extend(self, batch):
+        """
+        Appends the tokens `batch` to the sentences of the last call, and only computes
+        the inside cells that end in the new tokens (see `DioraBase.extend`). Returns the
+        chart.
+
+        """
+        diora = self.diora
+
+        self.prepare_index(self.batch.shape[1] + batch.shape[1])
+        self.batch = torch.cat([self.batch, batch], 1)
+        if self.span_memo is not None:
+            self.span_memo.set_batch(self.batch)
+
+        with torch.inference_mode():
+            leaves = self.get_leaves(batch)
+            diora.extend(None, leaves=leaves, arena=self.arena, batch_info_cache=self.batch_info_cache,
+                span_memo=self.span_memo)
+
+        return diora.chart
+
+    def parse_extend(self, batch):
+        """
+        Same as `parse`, but extends the sentences of the last call to `parse` (or
+        `parse_extend`) with the tokens `batch`. The inside chart and the CKY chart of
+        the previous tokens are reused, so a new token costs O(n^2) rather than O(n^3).
+
+        """
+        state = self.parse_predictor.cky_state
+        chart = self.extend(batch)
+        batch_map = {'sentences': self.batch}
+        return self.parse_predictor.batched_cky(batch_map, chart.split_s, state=state)
+
+    def parse(self, batch, lengths=None, constraints=None):
+        """
+        Returns the highest scoring tree of each sentence. Skips the outside pass.
+
+        """
+        chart = self.run(batch, lengths=lengths, outside=False, constraints=constraints)
+        batch_map = {'sentences': batch, 'lengths': lengths, 'constraints': constraints}
+        trees = self.parse_predictor.batched_cky(batch_map, chart.split_s)
+
+        if self.cache is not None:
+            self.cache_trees(chart, batch, lengths, constraints, trees)
+
+        return trees
+
+    def cache_trees(self, chart, batch, lengths, constraints, trees):
+        """
+        Stores the trees (and span vectors) of a batch in the cache, and returns the entries.
+
+        """
+        offset = self.diora.index.get_offset(batch.shape[1])
+        nlevels = chart.nlevels
+        entries = []
+
+        for i, tree in enumerate(trees):
+            n = batch.shape[1] if lengths is None else int(lengths[i])
+            entry = {'tree': tree}
+            if self.cache.store_vectors:
+                spans = [(pos, size) for pos, size in tree_to_spans(tree) if size <= nlevels]
+                idx = [offset[size - 1] + pos for pos, size in spans]
+                entry['spans'] = spans
+                entry['vectors'] = chart.inside_h[i, idx].to(chart.dtype).cpu().numpy()
+            self.cache.put(batch[i, :n].tolist(), entry, constraints[i] if constraints is not None else None)
+            entries.append(entry)
+        self.cache.flush()
+
+        return entries
+
+    def parse_sentences(self, sentences, constraints=None):
+        """
+        Returns the cache entry (see `ParseCache`) of each sentence, a list of token ids.
+        Duplicates are resolved before batching, so only the distinct sentences that are
+        not in the cache are parsed, in one packed batch.
+
+        """
+        assert self.cache is not None, 'Set `cache` first.'
+
+        entries, missing = [None] * len(sentences), {}
+        for i, tokens in enumerate(sentences):
+            c = constraints[i] if constraints is not None else None
+            key = self.cache.get_key(tokens, c)
+            if key in missing:
+                missing[key].append(i)
+                continue
+            entries[i] = self.cache.get(tokens, c)
+            if entries[i] is None:
+                missing[key] = [i]
+
+        if len(missing) > 0:
+            idx = [lst[0] for lst in missing.values()]
+            lengths = [len(sentences[i]) for i in idx]
+            batch = np.zeros((len(idx), max(lengths)), dtype=np.int64)
+            for j, i in enumerate(idx):
+                batch[j, :lengths[j]] = sentences[i]
+            device = self.diora.device
+            batch = torch.from_numpy(batch).to(device)
+            lengths = torch.tensor(lengths, dtype=torch.long, device=device)
+            batch_constraints = [constraints[i] for i in idx] if constraints is not None else None
+
+            chart = self.run(batch, lengths=lengths, outside=False, constraints=batch_constraints)
+            batch_map = {'sentences': batch, 'lengths': lengths, 'constraints': batch_constraints}
+            trees = self.parse_predictor.batched_cky(batch_map, chart.split_s)
+            new_entries = self.cache_trees(chart, batch, lengths, batch_constraints, trees)
+
+            for lst, entry in zip(missing.values(), new_entries):
+                for i in lst:
+                    entries[i] = entry
+
+        return entries
+
+    def span_vectors(self, batch, batch_index, positions, sizes, lengths=None, outside=True,
+                     constraints=None):
+        """
+        Returns a dict with the inside (and outside) vectors of the spans, one row per
+        (batch_index, position, size). The outside pass only computes the cells that
+        contain one of the spans.
+
+        """
+        # No spans (e.g. every phrase of the batch was filtered out).
+        if len(sizes) == 0:
+            empty = torch.zeros(0, self.diora.size, dtype=self.diora.dtype, device=batch.device)
+            result = {}
+            result['inside'] = empty
+            if outside:
+                result['outside'] = empty.clone()
+            return result
+
+        assert max(sizes) <= self.diora.get_num_levels(batch.shape[1]), \
+            'Spans wider than `max_span_width` are not in the chart.'
+
+        targets = (batch_index, positions, sizes)
+        chart = self.run(batch, lengths=lengths, outside=outside, constraints=constraints, targets=targets)
+
+        offset = self.diora.index.get_offset(batch.shape[1])
+        idx = [offset[size - 1] + pos for pos, size in zip(positions, sizes)]
+
+        result = {}
+        result['inside'] = chart.inside_h[batch_index, idx].to(chart.dtype)
+        if outside:
+            result['outside'] = chart.outside_h[batch_index, idx].to(chart.dtype)
+
+        return result
@@ -1,5 +1,5 @@
+import numpy as np
 import torch
-from diora.net.offset_cache import get_offset_cache
 
 
 class InsideIndex(object):
@@ -47,47 +47,38 @@ class InsideIndexCheck(object):
         return (tgt, sis) in self.check
 
 
-def get_inside_index(length, level, offset_cache=None, cuda=False):
-    if offset_cache is None:
-        offset_cache = get_offset_cache(length)
-    index = InsideIndex()
-    pairs = index.get_all_pairs(level, length)
+def get_offsets_np(length):
+    level = np.arange(length, dtype=np.int64)
+    ncells = length * (length + 1) // 2
+    return ncells - (length - level) * (length - level + 1) // 2
 
-    L = length - level
-    n_constituents = len(pairs) // L
-    idx_l, idx_r = [], []
 
-    for i in range(n_constituents):
-        index_l, index_r = [], []
+def get_inside_index_np(length, level):
+    """
+    Returns the chart indices of the left and right children for every (pos, split)
+    pair at the given level, flattened with pos as the outer dimension. The split
+    `i` of span (level, pos) has children (i, pos) and (level - i - 1, pos + i + 1).
 
-        lvl_l = i
-        lvl_r = level - i - 1
-        lstart, lend = 0, L
-        rstart, rend = length - L - lvl_r, length - lvl_r
+    """
+    offset = get_offsets_np(length)
+
+    L = length - level
+    N = level
 
-        if lvl_l < 0:
-            lvl_l = length + lvl_l
-        if lvl_r < 0:
-            lvl_r = length + lvl_r
+    pos = np.arange(L, dtype=np.int64).reshape(L, 1)
+    i = np.arange(N, dtype=np.int64).reshape(1, N)
 
-        for pos in range(lstart, lend):
-            offset = offset_cache[lvl_l]
-            idx = offset + pos
-            index_l.append(idx)
+    idx_l = offset[i] + pos
+    idx_r = offset[level - i - 1] + pos + i + 1
 
-        for pos in range(rstart, rend):
-            offset = offset_cache[lvl_r]
-            idx = offset + pos
-            index_r.append(idx)
+    return idx_l.reshape(-1), idx_r.reshape(-1)
 
-        idx_l.append(index_l)
-        idx_r.append(index_r)
+
+def get_inside_index(length, level, offset_cache=None, cuda=False):
+    idx_l, idx_r = get_inside_index_np(length, level)
 
     device = torch.cuda.current_device() if cuda else None
-    idx_l = torch.tensor(idx_l, dtype=torch.int64, device=device
-            ).transpose(0, 1).contiguous().flatten()
-    idx_r = torch.tensor(idx_r, dtype=torch.int64, device=device
-            ).transpose(0, 1).contiguous().flatten()
+    idx_l = torch.from_numpy(idx_l).to(device)
+    idx_r = torch.from_numpy(idx_r).to(device)
 
     return idx_l, idx_r
-
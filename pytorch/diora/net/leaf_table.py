@@ -0,0 +1,93 @@
+import os
+
+import torch
+
+
+class LeafTable(object):
+    r"""LeafTable
+
+    The normalized leaf (h, c) of every vocabulary entry, as a (V, 2, D) table. In eval
+    mode a leaf only depends on its token id, so the embedding lookup, the projection in
+    `Embed` and the leaf transform can be replaced by one gather. Architectures without
+    a cell state (MLP) have a (V, 1, D) table.
+
+    The table must be rebuilt whenever the model or the embeddings change.
+
+    """
+
+    def __init__(self, data, meta=None):
+        super(LeafTable, self).__init__()
+        self.data = data
+        self.meta = meta
+
+    @staticmethod
+    def get_meta(net, model_path=None):
+        """
+        Describes what the table was built from, to detect a stale file.
+
+        """
+        weight = net.embed.embeddings.weight
+        meta = {}
+        meta['vocab_size'] = weight.shape[0]
+        meta['embed_checksum'] = float(weight.double().sum())
+        meta['model_mtime'] = os.path.getmtime(model_path) if model_path is not None else None
+        return meta
+
+    @classmethod
+    def build(cls, net, batch_size=4096, model_path=None):
+        embed, diora = net.embed, net.diora
+        vocab_size = embed.embeddings.weight.shape[0]
+        device = embed.mat.device
+
+        lst = []
+        with torch.no_grad():
+            for start in range(0, vocab_size, batch_size):
+                ids = torch.arange(start, min(start + batch_size, vocab_size), device=device)
+                h, c = diora.leaf_transform(embed(ids.view(1, -1)))
+                cells = [h] if c is None else [h, c]
+                lst.append(torch.stack(cells, 2).squeeze(0))
+
+        return cls(torch.cat(lst, 0), meta=cls.get_meta(net, model_path))
+
+    @staticmethod
+    def get_path(model_path):
+        return '{}.leaf_table.pt'.format(model_path)
+
+    def save(self, path):
+        torch.save({'data': self.data.cpu(), 'meta': self.meta}, path)
+
+    @classmethod
+    def load(cls, path):
+        save_dict = torch.load(path, map_location=lambda storage, loc: storage)
+        return cls(save_dict['data'], meta=save_dict['meta'])
+
+    @classmethod
+    def load_or_build(cls, net, model_path=None):
+        """
+        If `model_path` is set, then the table is kept next to the checkpoint and only
+        rebuilt when it is stale.
+
+        """
+        if model_path is None:
+            return cls.build(net)
+
+        path = cls.get_path(model_path)
+        if os.path.exists(path):
+            table = cls.load(path)
+            if table.meta == cls.get_meta(net, model_path):
+                table.data = table.data.to(net.embed.mat.device)
+                return table
+
+        table = cls.build(net, model_path=model_path)
+        table.save(path)
+        return table
+
+    def __call__(self, x):
+        """
+        Returns the leaf (h, c) for a batch of token ids, or (h, None) without a cell state.
+
+        """
+        cells = self.data[x]
+        h = cells[:, :, 0]
+        c = cells[:, :, 1] if cells.shape[2] == 2 else None
+        return h, c
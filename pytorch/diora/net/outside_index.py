@@ -1,5 +1,6 @@
+import numpy as np
 import torch
-from diora.net.offset_cache import get_offset_cache
+from diora.net.inside_index import get_offsets_np
 
 
 class OutsideIndex(object):
@@ -90,39 +91,137 @@ class OutsideIndexCheck(object):
         return (par, sis) in self.check
 
 
-def get_outside_index(length, level, offset_cache=None, cuda=False):
-    if offset_cache is None:
-        offset_cache = get_offset_cache(length)
-    index = OutsideIndex()
-    pairs = index.get_all_pairs(level, length)
+def get_outside_coords_np(length, level):
+    """
+    Returns the (level, pos) of the parent and sibling for every (pair, pos) at the
+    given level as (N, L) arrays, and whether the sibling is to the right.
+
+    """
+    L = length - level
+    N = L - 1
+
+    i = np.arange(N, dtype=np.int64).reshape(N, 1)
+    j = np.arange(L, dtype=np.int64).reshape(1, L)
+
+    # The sibling is to the right of the target.
+    right = j < N - i
+
+    r_par_lvl = length - i - 1 - j
+    r_par_pos = j
+    r_sis_lvl = N - i - j - 1
+    r_sis_pos = level + 1 + j
+
+    # The sibling is to the left of the target.
+    jseen = j - (N - i)
+
+    l_par_lvl = length - N + jseen
+    l_par_pos = j - 1 - jseen
+    l_sis_lvl = jseen
+    l_sis_pos = j - 1 - jseen
+
+    par_lvl = np.where(right, r_par_lvl, l_par_lvl)
+    par_pos = np.where(right, r_par_pos, l_par_pos)
+    sis_lvl = np.where(right, r_sis_lvl, l_sis_lvl)
+    sis_pos = np.where(right, r_sis_pos, l_sis_pos)
+
+    return par_lvl, par_pos, sis_lvl, sis_pos, right
+
+
+def get_outside_index_np(length, level):
+    """
+    Returns the chart indices of the parent and sibling for every (pair, pos) at the
+    given level, flattened with the pair as the outer dimension. Matches the order
+    of `OutsideIndex.get_all_pairs`.
+
+    """
+    offset = get_offsets_np(length)
+
+    par_lvl, par_pos, sis_lvl, sis_pos, _ = get_outside_coords_np(length, level)
+
+    par_index = offset[par_lvl] + par_pos
+    sis_index = offset[sis_lvl] + sis_pos
+
+    return par_index.reshape(-1), sis_index.reshape(-1)
+
+
+def get_window_outside_index_np(length, level, nlevels):
+    """
+    Same as `get_outside_index_np`, but for a chart that only has the first `nlevels`
+    levels. Every position gets the same 2 * (nlevels - level - 1) pairs: for each
+    parent level, the target as the left child and then as the right child. Pairs that
+    fall outside of the sentence point to cell 0 and are not valid.
+
+    Returns the parent index, sibling index and validity, flattened with the pair as the
+    outer dimension.
+
+    """
+    offset = get_offsets_np(length)
+
+    L = length - level
+    M = nlevels - level - 1
+
+    pos = np.arange(L, dtype=np.int64).reshape(1, L)
+    lvl = np.arange(level + 1, nlevels, dtype=np.int64).reshape(M, 1)
 
-    par_lvl, par_pos = [], []
-    sis_lvl, sis_pos = [], []
+    # The sibling is to the right of the target.
+    r_par_pos = np.broadcast_to(pos, (M, L))
+    r_sis_pos = np.broadcast_to(pos + level + 1, (M, L))
 
-    for pair in pairs:
-        par, sis = pair
-        par_lvl.append(par[0])
-        par_pos.append(par[1] - par[0])
-        sis_lvl.append(sis[0])
-        sis_pos.append(sis[1] - sis[0])
+    # The sibling is to the left of the target.
+    l_par_pos = pos - (lvl - level)
+    l_sis_pos = l_par_pos
+
+    par_lvl = np.repeat(lvl, 2, axis=0)
+    sis_lvl = par_lvl - level - 1
+    par_pos = np.stack([r_par_pos, l_par_pos], axis=1).reshape(2 * M, L)
+    sis_pos = np.stack([r_sis_pos, l_sis_pos], axis=1).reshape(2 * M, L)
+
+    valid = (par_pos >= 0) & (par_pos + par_lvl < length)
+
+    par_index = np.where(valid, offset[par_lvl] + par_pos, 0)
+    sis_index = np.where(valid, offset[sis_lvl] + sis_pos, 0)
+
+    return par_index.reshape(-1), sis_index.reshape(-1), valid.reshape(-1)
+
+
+def get_window_outside_index(length, level, nlevels, cuda=False):
+    par_index, sis_index, valid = get_window_outside_index_np(length, level, nlevels)
 
     device = torch.cuda.current_device() if cuda else None
+    par_index = torch.from_numpy(par_index).to(device)
+    sis_index = torch.from_numpy(sis_index).to(device)
+    valid = torch.from_numpy(valid).to(device)
 
-    # Parent
-    index = []
-    for lvl, pos in zip(par_lvl, par_pos):
-        offset = offset_cache[lvl]
-        idx = offset + pos
-        index.append(idx)
-    par_index = torch.tensor(index, dtype=torch.int64, device=device)
-
-    # Sibling
-    index = []
-    for lvl, pos in zip(sis_lvl, sis_pos):
-        offset = offset_cache[lvl]
-        idx = offset + pos
-        index.append(idx)
-    sis_index = torch.tensor(index, dtype=torch.int64, device=device)
+    return par_index, sis_index, valid
 
-    return par_index, sis_index
 
+def get_outside_split_index_np(length, level):
+    """
+    Returns, for every (pair, pos) at the given level, the position of the parent's
+    split in a (ncells, length - 1) table of split scores, flattened. The split is
+    the level of the left child.
+
+    """
+    offset = get_offsets_np(length)
+
+    par_lvl, par_pos, sis_lvl, sis_pos, right = get_outside_coords_np(length, level)
+
+    split = np.where(right, level, sis_lvl)
+    index = (offset[par_lvl] + par_pos) * (length - 1) + split
+
+    return index.reshape(-1)
+
+
+def get_outside_split_index(length, level, cuda=False):
+    device = torch.cuda.current_device() if cuda else None
+    return torch.from_numpy(get_outside_split_index_np(length, level)).to(device)
+
+
+def get_outside_index(length, level, offset_cache=None, cuda=False):
+    par_index, sis_index = get_outside_index_np(length, level)
+
+    device = torch.cuda.current_device() if cuda else None
+    par_index = torch.from_numpy(par_index).to(device)
+    sis_index = torch.from_numpy(sis_index).to(device)
+
+    return par_index, sis_index
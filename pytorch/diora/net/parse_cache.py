@@ -0,0 +1,185 @@
+import collections
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+from diora.net.diora import get_bracket_constraints
+
+
+def get_fingerprint(net):
+    """
+    Returns a hash of the weights of `net` and of the DIORA settings that change its
+    trees, so that cached trees are never read back by a different model.
+
+    """
+    diora = net.diora
+    config = dict(
+        arch=type(diora).__name__,
+        factorized=diora.factorized,
+        fused=diora.fused,
+        compress=diora.compress,
+        topk=diora.topk,
+        max_span_width=diora.max_span_width,
+        storage_dtype=str(diora.storage_dtype),
+        quantized=any(getattr(m, 'quantized', None) is not None for m in net.modules()),
+        )
+
+    sha = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+    for name, tensor in sorted(net.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().float().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def encode_entry(entry):
+    value = dict(entry)
+    if 'vectors' in value:
+        value['vectors'] = value['vectors'].tolist()
+    return json.dumps(value)
+
+
+def decode_entry(value):
+    entry = json.loads(value)
+    if 'vectors' in entry:
+        entry['vectors'] = np.array(entry['vectors'], dtype=np.float32)
+    return entry
+
+
+class ParseCache(object):
+    r"""ParseCache
+
+    Parse results keyed by (model fingerprint, token ids, bracket constraints). Each
+    entry is a dict with the `tree`, and optionally the `spans` of the tree as (pos, size)
+    and their inside `vectors` (with `store_vectors`).
+
+    The most recently used `capacity` entries are kept in memory. If `path` is set, then
+    every entry is also written to a sqlite file as JSON (the trees and spans are read
+    back as lists), which is read on a memory miss and can be shared across runs. The
+    counters are `hits` (in memory or on disk), `disk_hits`, and `misses`.
+
+    """
+
+    def __init__(self, fingerprint, capacity=100000, path=None, store_vectors=False):
+        super(ParseCache, self).__init__()
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.store_vectors = store_vectors
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get_key(self, tokens, constraints=None):
+        tokens = [int(x) for x in tokens]
+        constraints = sorted([int(x) for x in b] for b in constraints) if constraints else None
+        data = json.dumps([self.fingerprint, tokens, constraints])
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, tokens, constraints=None):
+        key = self.get_key(tokens, constraints)
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.db is not None:
+            row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = decode_entry(row[0])
+                self.put_memory(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, tokens, value, constraints=None):
+        key = self.get_key(tokens, constraints)
+        self.put_memory(key, value)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)',
+                (key, encode_entry(value)))
+
+    def put_memory(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def get_stats(self):
+        stats = {}
+        stats['hits'] = self.hits
+        stats['disk_hits'] = self.disk_hits
+        stats['misses'] = self.misses
+        stats['size'] = len(self.memory)
+        return stats
+
+
+def get_dataset_keys(dataset, constraints_key=None):
+    extra = dataset['extra']
+    keys = []
+    for i, tokens in enumerate(dataset['sentences']):
+        constraints = extra[constraints_key][i] if constraints_key is not None else None
+        keys.append(json.dumps([list(tokens), constraints]))
+    return keys
+
+
+def dedupe_dataset(dataset, cache=None, constraints_key=None):
+    """
+    Resolves duplicate and cached sentences before batching. Returns:
+
+    - A copy of `dataset` with the first occurrence of each distinct sentence that is
+      not in `cache`.
+    - A dict from each of its example ids to the example ids of the duplicates.
+    - A list of (example_ids, tokens, entry) for the sentences found in `cache`.
+
+    `constraints_key` is the `extra` field with the bracket constraints, which are part
+    of the key (see `get_bracket_constraints`).
+
+    """
+    sentences = dataset['sentences']
+    extra = dataset['extra']
+    example_ids = extra['example_ids']
+
+    groups = collections.OrderedDict()
+    for i, key in enumerate(get_dataset_keys(dataset, constraints_key)):
+        groups.setdefault(key, []).append(i)
+
+    keep, duplicates, cached = [], {}, []
+    for idx in groups.values():
+        i = idx[0]
+        ids = [example_ids[j] for j in idx]
+        if cache is not None:
+            batch_map = {k: [v[i]] for k, v in extra.items()}
+            constraints = get_bracket_constraints(batch_map, constraints_key)
+            entry = cache.get(sentences[i], constraints[0] if constraints is not None else None)
+            if entry is not None:
+                cached.append((ids, sentences[i], entry))
+                continue
+        keep.append(i)
+        duplicates[ids[0]] = ids[1:]
+
+    new_dataset = dict(dataset)
+    new_dataset['sentences'] = [sentences[i] for i in keep]
+    new_dataset['extra'] = {k: [v[i] for i in keep] for k, v in extra.items()}
+
+    return new_dataset, duplicates, cached
@@ -0,0 +1,51 @@
+import torch
+
+
+class QuantizedMatrix(object):
+    r"""QuantizedMatrix
+
+    An int8 copy of a (input_size, output_size) matrix, with one scale per output
+    column. Inputs are quantized on the fly, one scale per call (dynamic quantization),
+    and multiplied by the fbgemm/qnnpack kernels. CPU and inference only.
+
+    """
+
+    def __init__(self, mat):
+        super(QuantizedMatrix, self).__init__()
+        weight = mat.detach().float().t().contiguous()
+        scales = weight.abs().max(dim=1)[0].clamp(min=1e-8) / 127
+        zero_points = torch.zeros(weight.shape[0], dtype=torch.long)
+        qweight = torch.quantize_per_channel(weight, scales.double(), zero_points, axis=0, dtype=torch.qint8)
+        self.shape = mat.shape
+        self.packed = torch.ops.quantized.linear_prepack(qweight, None)
+
+    def __call__(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1]).contiguous()
+        y = torch.ops.quantized.linear_dynamic(x, self.packed)
+        return y.view(*shape[:-1], self.shape[1])
+
+
+def get_quantizable_modules(net):
+    return [m for m in net.modules() if hasattr(m, 'get_matrices')]
+
+
+def quantize(net):
+    """
+    Replaces the matrices of the compose, score and embedding projection modules of
+    `net` with int8 copies. The float parameters are kept, so `dequantize` restores
+    the original model.
+
+    """
+    for module in get_quantizable_modules(net):
+        assert not module.training, 'Quantized modules are for inference only. Call `eval()` first.'
+        matrices = module.get_matrices()
+        assert all(not mat.is_cuda for mat in matrices.values()), 'Quantized kernels run on CPU only.'
+        module.quantized = {k: QuantizedMatrix(mat) for k, mat in matrices.items()}
+    return net
+
+
+def dequantize(net):
+    for module in get_quantizable_modules(net):
+        module.quantized = None
+    return net
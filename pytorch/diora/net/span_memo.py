@@ -0,0 +1,130 @@
+import torch
+
+
+# An odd 64-bit multiplier. Products wrap around, so the hash is a polynomial mod 2^64.
+HASH_BASE = 0x5851F42D4C957F2D
+
+
+class SpanMemo(object):
+    r"""SpanMemo
+
+    Inside cells keyed by their tokens, for inference. A cell's (h, c, s) and split
+    scores only depend on the tokens of its span (the leaves only depend on their token
+    id), so a span that is in several sentences of a batch, or in a recent batch, only
+    needs to be composed once (see `inside_compute_memo`).
+
+    There is one table per level, with the hash of each span's token ids sorted for
+    lookup with `searchsorted`, and the token ids themselves. A row is only a hit when
+    its token ids are the span's, so a hash collision is a miss (and the span is
+    composed again). A table is cleared when it would grow past `capacity` rows. Only the levels up to `max_level` are memoized (all of them if None), since
+    longer spans rarely repeat. The counters are the number of `cells` at those levels,
+    and how many were `computed`.
+
+    Constrained batches, where a cell depends on more than its span, and pruned levels
+    are computed as usual. The tables must be cleared (`reset`) whenever the
+    model changes.
+
+    """
+
+    def __init__(self, capacity=100000, max_level=4):
+        super(SpanMemo, self).__init__()
+        self.capacity = capacity
+        self.max_level = max_level
+        self.tables = {}
+        self.tokens = None
+        self.lengths = None
+        self.cells = 0
+        self.computed = 0
+
+    def reset(self):
+        self.tables = {}
+
+    def set_batch(self, tokens, lengths=None):
+        """
+        Sets the token ids of the next batch, (batch_size, length). With `lengths`, the
+        cells past the end of a sentence are not memoized.
+
+        """
+        assert not torch.is_floating_point(tokens), 'Spans are keyed by token ids.'
+        self.tokens = tokens
+        self.lengths = lengths
+
+    def is_memoized(self, level):
+        return self.max_level is None or level <= self.max_level
+
+    def get_spans(self, batch_info):
+        """
+        Returns the token ids of each cell [start, end) of the level as a
+        (batch_size, L, level + 1) tensor, and whether the cell is in its sentence.
+
+        """
+        level, start, end = batch_info.level, batch_info.start, batch_info.end
+        L = end - start
+        tokens = self.tokens.to(torch.int64)
+
+        spans = torch.stack([tokens[:, start+k:end+k] for k in range(level + 1)], 2)
+
+        if self.lengths is None:
+            valid = torch.ones(spans.shape[:2], dtype=torch.bool, device=spans.device)
+        else:
+            pos = torch.arange(start, end, device=spans.device).view(1, L)
+            valid = pos + level < self.lengths.view(-1, 1)
+
+        return spans, valid
+
+    def get_keys(self, spans):
+        """
+        Returns the hash of the token ids of each span, over the last dimension.
+
+        """
+        keys = torch.zeros_like(spans[..., 0])
+        for k in range(spans.shape[-1]):
+            keys = keys * HASH_BASE + spans[..., k] + 1
+        return keys
+
+    def lookup(self, level, keys, spans):
+        """
+        Returns the row of each span in the table of the level, and whether it is there.
+        `spans` must be unique, and `keys` are their hashes.
+
+        """
+        table = self.tables.get(level, None)
+        if table is None:
+            return torch.zeros_like(keys), torch.zeros_like(keys, dtype=torch.bool)
+
+        rows = torch.searchsorted(table['keys'], keys).clamp(max=table['keys'].shape[0] - 1)
+        found = (table['keys'][rows] == keys) & (table['tokens'][rows] == spans).all(1)
+
+        return rows, found
+
+    def get(self, level, rows):
+        table = self.tables[level]
+        return {k: v[rows] for k, v in table.items() if k not in ('keys', 'tokens')}
+
+    def put(self, level, keys, spans, values):
+        """
+        Adds new rows to the table of the level. `values` is a dict of tensors, with one
+        row per span, and `keys` are the hashes of the spans.
+
+        """
+        values = dict(values, tokens=spans)
+
+        table = self.tables.get(level, None)
+        if table is not None and table['keys'].shape[0] + keys.shape[0] > self.capacity:
+            table = None
+
+        if table is not None:
+            keys = torch.cat([table['keys'], keys], 0)
+            values = {k: torch.cat([table[k], v], 0) for k, v in values.items()}
+
+        keys, order = keys.sort()
+        table = {k: v[order] for k, v in values.items()}
+        table['keys'] = keys
+        self.tables[level] = table
+
+    def get_stats(self):
+        stats = {}
+        stats['cells'] = self.cells
+        stats['computed'] = self.computed
+        stats['size'] = sum(table['keys'].shape[0] for table in self.tables.values())
+        return stats
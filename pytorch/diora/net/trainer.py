@@ -10,6 +10,13 @@ import torch.optim as optim
 from diora.net.diora import DioraTreeLSTM
 from diora.net.diora import DioraMLP
 from diora.net.diora import DioraMLPShared
+from diora.net.diora import matmul
+from diora.net.diora import get_bracket_constraints
+from diora.net.chart_arena import ChartArena
+from diora.net.index_table import IndexTable
+from diora.net.leaf_table import LeafTable
+from diora.net.compiled import enable_compile
+from diora.net.quantize import quantize
 
 from diora.logging.configuration import get_logger
 
@@ -18,6 +25,21 @@ from diora.analysis.cky import ParsePredictor as CKY
 from diora.data.reading import tree_to_spans
 
 
+def token_mean(loss, info):
+    """
+    Averages a per-token loss. In a packed batch, the padding tokens are ignored.
+
+    """
+    lengths = info.get('lengths', None) if info is not None else None
+    if lengths is None:
+        return loss.mean()
+    batch_size = lengths.shape[0]
+    length = loss.shape[0] // batch_size
+    mask = torch.arange(length, device=loss.device).view(1, -1) < lengths.view(-1, 1)
+    mask = mask.view(-1).to(loss.dtype)
+    return (loss * mask).sum() / mask.sum()
+
+
 class ReconstructionLoss(nn.Module):
     name = 'reconstruct_loss'
 
@@ -63,14 +85,14 @@ class ReconstructionLoss(nn.Module):
         score = torch.cat([xp, xn], 2)
 
         # Calculate loss.
-        lossfn = nn.MultiMarginLoss(margin=self.margin)
+        lossfn = nn.MultiMarginLoss(margin=self.margin, reduction='none')
         inputs = score.view(batch_size * length, k + 1)
         device = torch.cuda.current_device() if self._cuda else None
         outputs = torch.full((inputs.shape[0],), 0, dtype=torch.int64, device=device)
 
         self.loss_hook(sentences, neg_samples, inputs)
 
-        loss = lossfn(inputs, outputs)
+        loss = token_mean(lossfn(inputs, outputs), info)
 
         ret = dict(reconstruction_loss=loss)
 
@@ -123,14 +145,14 @@ class ReconstructionSoftmaxLoss(nn.Module):
         score = torch.cat([xp, xn], 2)
 
         # Calculate loss.
-        lossfn = nn.CrossEntropyLoss()
+        lossfn = nn.CrossEntropyLoss(reduction='none')
         inputs = score.view(batch_size * length, k + 1)
         device = torch.cuda.current_device() if self._cuda else None
         outputs = torch.full((inputs.shape[0],), 0, dtype=torch.int64, device=device)
 
         self.loss_hook(sentences, neg_samples, inputs)
 
-        loss = lossfn(inputs, outputs)
+        loss = token_mean(lossfn(inputs, outputs), info)
 
         ret = dict(reconstruction_softmax_loss=loss)
 
@@ -243,7 +265,7 @@ class SemiSupervisedParsingLoss(nn.Module):
         span_sets = [set(span_lst) for span_lst in spans]
 
         # Chart.
-        chart = [torch.full((length-i, batch_size), 1, dtype=torch.float, device=device) for i in range(length)]
+        chart = [torch.full((length-i, batch_size), 1, dtype=scalars[1].dtype, device=device) for i in range(length)]
 
         # Backpointers.
         bp = {}
@@ -264,7 +286,7 @@ class SemiSupervisedParsingLoss(nn.Module):
                 to_choose_assert = [False] * batch_size
 
                 # Assumes that the bottom-left most leaf is in the first constituent.
-                spbatch = scalars[level][pos]
+                spbatch = scalars[level][:, pos]
 
                 for idx in range(N):
                     # (level, pos)
@@ -332,7 +354,7 @@ class SemiSupervisedParsingLoss(nn.Module):
         span_sets = [set(span_lst) for span_lst in spans]
 
         # Chart.
-        chart = [torch.full((length-i, batch_size), 1, dtype=torch.float, device=device) for i in range(length)]
+        chart = [torch.full((length-i, batch_size), 1, dtype=scalars[1].dtype, device=device) for i in range(length)]
 
         # Backpointers.
         bp = {}
@@ -353,7 +375,7 @@ class SemiSupervisedParsingLoss(nn.Module):
                 to_choose_assert = [False] * batch_size
 
                 # Assumes that the bottom-left most leaf is in the first constituent.
-                spbatch = scalars[level][pos]
+                spbatch = scalars[level][:, pos]
 
                 for idx in range(N):
                     # (level, pos)
@@ -430,7 +452,7 @@ class SemiSupervisedParsingLoss(nn.Module):
         span_sets = [set(span_lst) for span_lst in spans]
 
         # Chart.
-        chart = [torch.full((length-i, batch_size), 1, dtype=torch.float, device=device) for i in range(length)]
+        chart = [torch.full((length-i, batch_size), 1, dtype=scalars[1].dtype, device=device) for i in range(length)]
 
         # Backpointers.
         bp = {}
@@ -451,7 +473,7 @@ class SemiSupervisedParsingLoss(nn.Module):
                 to_choose_assert = [False] * batch_size
 
                 # Assumes that the bottom-left most leaf is in the first constituent.
-                spbatch = scalars[level][pos]
+                spbatch = scalars[level][:, pos]
 
                 for idx in range(N):
                     # (level, pos)
@@ -629,6 +651,7 @@ class Embed(nn.Module):
         self.size = size
         self.embeddings = embeddings
         self.mat = nn.Parameter(torch.FloatTensor(size, input_size))
+        self.quantized = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -636,10 +659,13 @@ class Embed(nn.Module):
         for i, param in enumerate(params):
             param.data.normal_()
 
+    def get_matrices(self):
+        return {'mat': self.mat.t()}
+
     def forward(self, x):
         batch_size, length = x.shape
         e = self.embeddings(x.view(-1))
-        t = torch.mm(e, self.mat.t()).view(batch_size, length, -1)
+        t = matmul(self, 'mat', e).view(batch_size, length, -1)
         return t
 
 
@@ -650,6 +676,9 @@ class Net(nn.Module):
 
         self.embed = embed
         self.diora = diora
+        self.leaf_table = None
+        # If set, then DIORA runs under autocast with this dtype. See `forward`.
+        self.autocast_dtype = None
         self.loss_func_names = [m.name for m in loss_funcs]
 
         for m in loss_funcs:
@@ -679,18 +708,37 @@ class Net(nn.Module):
         return ret, loss
 
     def forward(self, batch, neg_samples=None, compute_loss=True, info=None):
-        # Embed
-        embed = self.embed(batch)
-
-        # Run DIORA
-        self.diora(embed)
+        lengths = info.get('lengths', None) if info is not None else None
+        constraints = info.get('constraints', None) if info is not None else None
+        chart = info.get('chart', None) if info is not None else None
+
+        # With a frozen encoder, the chart may be read from a cache (see `Trainer.run_net`).
+        if chart is not None:
+            self.diora.init_with_cache(chart, lengths=lengths)
+            embed, leaves = None, None
+        # Embed. In eval mode, the leaves may be read from a precomputed table.
+        elif self.leaf_table is not None and not self.training:
+            embed = None
+            leaves = self.leaf_table(batch)
+        else:
+            embed = self.embed(batch)
+            leaves = None
+
+        # Run DIORA. Under autocast only the compose and score matmuls run in lower
+        # precision. The chart is stored in the parameters' dtype, so the softmax over
+        # splits and the normalization after each matmul run in fp32 (by type
+        # promotion), and the losses run outside of autocast.
+        device_type = batch.device.type
+        if chart is None:
+            with torch.autocast(device_type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+                self.diora(embed, lengths=lengths, leaves=leaves, constraints=constraints)
 
         # Compute Loss
         if compute_loss:
             ret, loss = self.compute_loss(batch, neg_samples, info=info)
         else:
-            ret, loss = {}, torch.full((1, 1), 1, dtype=torch.float32,
-                device=embed.device)
+            ret, loss = {}, torch.full((1, 1), 1, dtype=self.diora.dtype,
+                device=batch.device)
 
         # Results
         ret['total_loss'] = loss
@@ -710,11 +758,37 @@ class Trainer(object):
 
         self.parallel_model = None
 
+        # Compare against a fp32 step every k train steps (with --precision).
+        self.shadow_every = None
+        self.nsteps = 0
+
+        # The batch field with the bracket constraints of each sentence (see
+        # `get_bracket_constraints`).
+        self.bracket_constraints = None
+
+        # The charts of the training examples, once the encoder is frozen (see
+        # diora.net.chart_cache).
+        self.chart_cache = None
+
         print("Trainer initialized with {} gpus.".format(ngpus))
 
-    def freeze_diora(self):
+    def freeze_diora(self, embed=False):
         for p in self.net.diora.parameters():
             p.requires_grad = False
+        # The leaves depend on the embedding projection too.
+        if embed:
+            for p in self.net.embed.parameters():
+                p.requires_grad = False
+
+    def is_encoder_frozen(self):
+        """
+        Whether the charts can no longer change: neither DIORA nor the embedding
+        projection is trained.
+
+        """
+        net = self.get_single_net(self.net)
+        params = list(net.embed.parameters()) + list(net.diora.parameters())
+        return not any(p.requires_grad for p in params)
 
     def parameter_norm(self, requires_grad=True, diora=False):
         net = self.net.diora if diora else self.net
@@ -788,12 +862,28 @@ class Trainer(object):
         batch = batch_map['sentences']
         neg_samples = batch_map.get('neg_samples', None)
         info = self.prepare_info(batch_map)
+
+        # With a frozen encoder, each training example's chart is computed once, and then
+        # read from the cache.
+        chart_cache = None
+        if self.chart_cache is not None and self.net.training and self.is_encoder_frozen():
+            chart_cache = self.chart_cache
+        if chart_cache is not None and chart_cache.contains(batch_map['index']):
+            info['chart'] = chart_cache.read(batch_map['index'], batch.shape[1], device=batch.device)
+            chart_cache = None
+
         out = self.net(batch, neg_samples=neg_samples, compute_loss=compute_loss, info=info)
+
+        if chart_cache is not None:
+            chart_cache.write(batch_map['index'])
+
         return out
 
     def gradient_update(self, loss):
         self.optimizer.zero_grad()
         loss.backward()
+        # The chart is no longer needed for backward, so its buffers can be recycled.
+        self.get_single_net(self.net).diora.release_chart()
         params = [p for p in self.net.parameters() if p.requires_grad]
         torch.nn.utils.clip_grad_norm_(params, 5.0)
         self.optimizer.step()
@@ -811,6 +901,11 @@ class Trainer(object):
         info = {}
         if 'spans' in batch_map:
             info['spans'] = batch_map['spans']
+        if batch_map.get('lengths', None) is not None:
+            info['lengths'] = batch_map['lengths']
+        constraints = get_bracket_constraints(batch_map, self.bracket_constraints)
+        if constraints is not None:
+            info['constraints'] = constraints
         return info
 
     def step(self, *args, **kwargs):
@@ -834,6 +929,13 @@ class Trainer(object):
             self.net.eval()
         multigpu = self.ngpus > 1 and train
 
+        # The shadow runs before the step, so that it sees the same parameters, and the
+        # chart of the step is the one that is left in DIORA (e.g. for parsing).
+        if train and self.shadow_every and (self.nsteps + 1) % self.shadow_every == 0:
+            divergence = self.precision_divergence(batch_map)
+            get_logger().info('precision divergence step={} {}'.format(self.nsteps + 1,
+                ' '.join(['{}={:.4g}'.format(k, v) for k, v in divergence.items()])))
+
         with torch.set_grad_enabled(train):
             model_output = self.run_net(batch_map, compute_loss=compute_loss, multigpu=multigpu)
 
@@ -842,11 +944,49 @@ class Trainer(object):
 
         if train:
             self.gradient_update(total_loss)
+            self.nsteps += 1
 
         result = self.prepare_result(batch_map, model_output)
 
         return result
 
+    def precision_divergence(self, batch_map):
+        """
+        Runs the batch with the net's autocast dtype and in fp32, and returns how far
+        apart the losses, outside cells and gradients are. Does not change the
+        parameters or their gradients.
+
+        """
+        net = self.get_single_net(self.net)
+        autocast_dtype = net.autocast_dtype
+        params = [p for p in net.parameters() if p.requires_grad]
+        info = self.prepare_info(batch_map)
+
+        outputs = []
+        try:
+            for dtype in (autocast_dtype, None):
+                net.autocast_dtype = dtype
+                model_output = net(batch_map['sentences'], neg_samples=batch_map.get('neg_samples', None),
+                    info=info)
+                loss = model_output['total_loss'].mean(dim=0).sum()
+                grads = torch.autograd.grad(loss, params, allow_unused=True)
+                grad = torch.cat([g.view(-1) for g in grads if g is not None])
+                outputs.append((loss.item(), net.diora.outside_h.detach().clone(), grad))
+                net.diora.release_chart()
+        finally:
+            net.autocast_dtype = autocast_dtype
+
+        (loss, h, grad), (loss_fp32, h_fp32, grad_fp32) = outputs
+
+        result = {}
+        result['loss'] = loss
+        result['loss_fp32'] = loss_fp32
+        result['loss_rel_diff'] = abs(loss - loss_fp32) / max(abs(loss_fp32), 1e-8)
+        result['cell_max_diff'] = (h - h_fp32).abs().max().item()
+        result['grad_cosine'] = torch.nn.functional.cosine_similarity(grad, grad_fp32, dim=0).item()
+        result['grad_rel_err'] = ((grad - grad_fp32).norm() / grad_fp32.norm().clamp(min=1e-8)).item()
+        return result
+
 
 def build_net(options, embeddings=None, batch_iterator=None, random_seed=None):
 
@@ -872,13 +1012,24 @@ def build_net(options, embeddings=None, batch_iterator=None, random_seed=None):
     embedding_layer = nn.Embedding.from_pretrained(torch.from_numpy(embeddings), freeze=True)
     embed = Embed(embedding_layer, input_size=input_dim, size=size)
 
+    if options.packed:
+        assert options.reconstruct_mode != 'semi', 'Packed batches do not support "semi".'
+
+    # Checked here, since the chart is only built with lower precision storage at inference.
+    if options.fused_chart:
+        assert options.chart_precision == 'fp32', \
+            'The fused chart stores h, c and s in one buffer, so --fused_chart requires --chart_precision fp32.'
+
     # Diora
     if options.arch == 'treelstm':
-        diora = DioraTreeLSTM(size, outside=True, normalize=normalize, compress=False)
+        diora = DioraTreeLSTM(size, outside=True, normalize=normalize, compress=False,
+            factorized=options.factorized, fused=options.fused_chart)
     elif options.arch == 'mlp':
-        diora = DioraMLP(size, outside=True, normalize=normalize, compress=False)
+        diora = DioraMLP(size, outside=True, normalize=normalize, compress=False,
+            factorized=options.factorized, fused=options.fused_chart)
     elif options.arch == 'mlp-shared':
-        diora = DioraMLPShared(size, outside=True, normalize=normalize, compress=False)
+        diora = DioraMLPShared(size, outside=True, normalize=normalize, compress=False,
+            factorized=options.factorized, fused=options.fused_chart)
 
     # Loss
     loss_funcs = get_loss_funcs(options, batch_iterator, embedding_layer)
@@ -886,6 +1037,35 @@ def build_net(options, embeddings=None, batch_iterator=None, random_seed=None):
     # Net
     net = Net(embed, diora, loss_funcs=loss_funcs)
 
+    # Index table.
+    if options.index_max_length is not None:
+        cache_dir = options.index_cache_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(options.experiment_path, 'index_cache')
+        diora.index_table = IndexTable.load_or_build(cache_dir, options.index_max_length)
+
+    # Chart arena.
+    if options.chart_arena_mb is not None:
+        diora.arena = ChartArena(max_bytes=int(options.chart_arena_mb * 2**20))
+
+    # Gradient checkpointing.
+    diora.checkpoint_every = options.checkpoint_every
+    if options.checkpoint_budget_mb is not None:
+        diora.checkpoint_budget = int(options.checkpoint_budget_mb * 2**20)
+
+    # Split pruning.
+    diora.topk = options.topk_splits
+
+    # Windowed chart.
+    diora.max_span_width = options.max_span_width
+
+    # Chart storage precision (inference only).
+    diora.storage_dtype = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[options.chart_precision]
+
+    # Chunked levels.
+    if options.chunk_budget_mb is not None:
+        diora.chunk_budget = int(options.chunk_budget_mb * 2**20)
+
     # Load model.
     if options.load_model_path is not None:
         logger.info('Loading model: {}'.format(options.load_model_path))
@@ -898,6 +1078,24 @@ def build_net(options, embeddings=None, batch_iterator=None, random_seed=None):
         net.cuda()
         diora.cuda()
 
+    # Mixed precision.
+    if options.precision == 'bf16':
+        net.autocast_dtype = torch.bfloat16
+
+    # Int8 weights (inference only).
+    if options.quantize:
+        net.eval()
+        quantize(net)
+
+    # Leaf table (eval only).
+    if options.leaf_table:
+        model_path = options.load_model_path if options.save_leaf_table else None
+        net.leaf_table = LeafTable.load_or_build(net, model_path)
+
+    # Compiled level functions (see `warmup_compiled` in scripts/train.py).
+    if options.compile:
+        enable_compile(diora)
+
     if cuda and options.multigpu:
         net = torch.nn.parallel.DistributedDataParallel(
             net, device_ids=[rank], output_device=rank)
@@ -905,6 +1103,8 @@ def build_net(options, embeddings=None, batch_iterator=None, random_seed=None):
     # Trainer
     trainer = Trainer(net, k_neg=k_neg, ngpus=ngpus, cuda=cuda)
     trainer.rank = rank
+    trainer.shadow_every = options.precision_shadow_every if options.precision != 'fp32' else None
+    trainer.bracket_constraints = options.bracket_constraints
     trainer.experiment_name = options.experiment_name # for multigpu cleanup
     trainer.init_optimizer(optim.Adam, dict(lr=lr, betas=(0.9, 0.999), eps=1e-8))
 
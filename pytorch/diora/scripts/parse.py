@@ -1,46 +1,15 @@
 import json
-import types
 
 import torch
 
 from train import argument_parser, parse_args, configure
 from train import get_validation_dataset, get_validation_iterator
-from train import build_net
+from train import build_net, warmup_compiled, init_parse_cache, init_span_memo, finish_inference
 
 from diora.logging.configuration import get_logger
 
-from diora.analysis.cky import ParsePredictor as CKY
-
-
-def override_init_with_batch(var):
-    init_with_batch = var.init_with_batch
-
-    def func(self, *args, **kwargs):
-        init_with_batch(*args, **kwargs)
-        self.saved_scalars = {i: {} for i in range(self.length)}
-        self.saved_scalars_out = {i: {} for i in range(self.length)}
-
-    var.init_with_batch = types.MethodType(func, var)
-
-
-def override_inside_hook(var):
-    def func(self, level, h, c, s):
-        length = self.length
-        B = self.batch_size
-        L = length - level
-
-        assert s.shape[0] == B
-        assert s.shape[1] == L
-        # assert s.shape[2] == N
-        assert s.shape[3] == 1
-        assert len(s.shape) == 4
-        smax = s.max(2, keepdim=True)[0]
-        s = s - smax
-
-        for pos in range(L):
-            self.saved_scalars[level][pos] = s[:, pos, :]
-
-    var.inside_hook = types.MethodType(func, var)
+from diora.net.inference import DioraInference
+from diora.net.diora import get_bracket_constraints
 
 
 def replace_leaves(tree, leaves):
@@ -79,18 +48,23 @@ def run(options):
 
     diora = trainer.net.diora
 
-    ## Monkey patch parsing specific methods.
-    override_init_with_batch(diora)
-    override_inside_hook(diora)
-
     ## Turn off outside pass.
     trainer.net.diora.outside = False
 
     ## Eval mode.
     trainer.net.eval()
 
-    ## Topk predictor.
-    parse_predictor = CKY(net=diora, word2idx=word2idx)
+    ## Inference engine. Parsing only needs the inside pass.
+    engine = DioraInference.from_net(trainer.get_single_net(trainer.net))
+    init_span_memo(options, engine)
+
+    ## Each distinct sentence is parsed once, and cached trees are not parsed again.
+    validation_dataset, duplicates, cached = init_parse_cache(options, trainer, engine, validation_dataset)
+    if options.parse_cache:
+        validation_iterator = get_validation_iterator(options, validation_dataset)
+
+    if options.compile:
+        warmup_compiled(options, trainer, validation_iterator, mode='inference')
 
     batches = validation_iterator.get_iterator(random_seed=options.seed)
 
@@ -99,6 +73,15 @@ def run(options):
     fw = open("/Users/shrutijalan/data/conll2003/eng_train_parse.json", 'w')
 
     with torch.no_grad():
+        for example_ids, tokens, entry in cached:
+            tr = replace_leaves(entry['tree'], [idx2word[idx] for idx in tokens])
+            for example_id in example_ids:
+                o = dict(example_id=example_id, tree=tr)
+
+                print(json.dumps(o))
+                json.dump(o, fw)
+                fw.write('\n')
+
         for i, batch_map in enumerate(batches):
             sentences = batch_map['sentences']
             batch_size = sentences.shape[0]
@@ -109,33 +92,38 @@ def run(options):
                 for i in range(batch_size):
                     example_id = batch_map['example_ids'][i]
                     tokens = sentences[i].tolist()
+                    if batch_map.get('lengths', None) is not None:
+                        tokens = tokens[:batch_map['lengths'][i].item()]
                     words = [idx2word[idx] for idx in tokens]
-                    if length == 2:
-                        o = dict(example_id=example_id, tree=(words[0], words[1]))
-                    elif length == 1:
-                        o = dict(example_id=example_id, tree=words[0])
-                    print(json.dumps(o))
+                    for example_id in [example_id] + duplicates.get(example_id, []):
+                        if len(words) == 2:
+                            o = dict(example_id=example_id, tree=(words[0], words[1]))
+                        elif len(words) == 1:
+                            o = dict(example_id=example_id, tree=words[0])
+                        print(json.dumps(o))
 
-                    json.dump(o, fw)
-                    fw.write('\n')
+                        json.dump(o, fw)
+                        fw.write('\n')
 
                 continue
 
-            _ = trainer.step(batch_map, train=False, compute_loss=False)
-
-            trees = parse_predictor.parse_batch(batch_map)
+            constraints = get_bracket_constraints(batch_map, options.bracket_constraints)
+            trees = engine.parse(sentences, lengths=batch_map.get('lengths', None), constraints=constraints)
 
             for ii, tr in enumerate(trees):
                 example_id = batch_map['example_ids'][ii]
                 s = [idx2word[idx] for idx in sentences[ii].tolist()]
                 tr = replace_leaves(tr, s)
-                o = dict(example_id=example_id, tree=tr)
+                for example_id in [example_id] + duplicates.get(example_id, []):
+                    o = dict(example_id=example_id, tree=tr)
 
-                print(json.dumps(o))
-                json.dump(o, fw)
-                fw.write('\n')
+                    print(json.dumps(o))
+                    json.dump(o, fw)
+                    fw.write('\n')
         fw.close()
 
+    finish_inference(engine)
+
     # with torch.no_grad():
     #     for i, batch_map in enumerate(batches):
     #         sentences = batch_map['sentences']
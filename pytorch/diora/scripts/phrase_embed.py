@@ -44,9 +44,10 @@ import numpy as np
 
 from train import argument_parser, parse_args, configure
 from train import get_validation_dataset, get_validation_iterator
-from train import build_net
+from train import build_net, init_span_memo, finish_inference
 
 from diora.logging.configuration import get_logger
+from diora.net.inference import DioraInference
 
 try:
     import faiss
@@ -76,22 +77,6 @@ def get_cell_index(entity_labels, i_label=0, i_pos=1, i_size=2):
     return batch_index, positions, sizes, labels
 
 
-def get_many_cells(diora, chart, batch_index, positions, sizes):
-    cells = []
-    length = diora.length
-
-    idx = []
-    for bi, pos, size in zip(batch_index, positions, sizes):
-        level = size - 1
-        offset = diora.index.get_offset(length)[level]
-        absolute_pos = offset + pos
-        idx.append(absolute_pos)
-
-    cells = chart[batch_index, idx]
-
-    return cells
-
-
 def get_many_phrases(batch, batch_index, positions, sizes):
     batch = batch.tolist()
     lst = []
@@ -187,6 +172,10 @@ def run(options):
     ## Eval mode.
     trainer.net.eval()
 
+    ## Inference engine.
+    engine = DioraInference.from_net(trainer.get_single_net(trainer.net))
+    init_span_memo(options, engine)
+
     batches = validation_iterator.get_iterator(random_seed=options.seed)
 
     logger.info('Beginning to embed phrases.')
@@ -201,8 +190,6 @@ def run(options):
             if length <= 2:
                 continue
 
-            _ = trainer.step(batch_map, train=False, compute_loss=False)
-
             entity_labels = batch_map['entity_labels']
             batch_index, positions, sizes, labels = get_cell_index(entity_labels)
 
@@ -220,11 +207,14 @@ def run(options):
             batch_result['positions'] = cell_index[1]
             batch_result['sizes'] = cell_index[2]
             batch_result['phrases'] = get_many_phrases(sentences, *cell_index)
-            batch_result['inside'] = get_many_cells(diora, diora.inside_h, *cell_index)
-            batch_result['outside'] = get_many_cells(diora, diora.outside_h, *cell_index)
+            vectors = engine.span_vectors(sentences, *cell_index, lengths=batch_map.get('lengths', None))
+            batch_result['inside'] = vectors['inside']
+            batch_result['outside'] = vectors['outside']
 
             batch_recorder.record(**batch_result)
 
+    finish_inference(engine)
+
     result = batch_recorder.get_flattened_result()
 
     # 2. Build an index of nearest neighbors.
@@ -0,0 +1,97 @@
+import json
+import time
+
+import torch
+
+from train import argument_parser, parse_args, configure
+from train import get_validation_dataset, get_validation_iterator
+from train import build_net
+
+from diora.logging.configuration import get_logger
+
+from diora.analysis.agreement import TreeAgreement
+from diora.net.inference import DioraInference
+
+
+def run_batch(engine, sentences, lengths, topk):
+    """
+    Returns the trees and the outside vectors of the leaves, and the time it took.
+
+    """
+    diora = engine.diora
+    diora.topk = topk
+
+    start = time.time()
+    chart = engine.run(sentences, lengths=lengths)
+    batch_map = {'sentences': sentences, 'lengths': lengths}
+    trees = engine.parse_predictor.batched_cky(batch_map, chart.split_s)
+    elapsed = time.time() - start
+
+    leaves = chart.outside_h[:, :sentences.shape[1]].to(chart.dtype).clone()
+
+    return trees, leaves, elapsed
+
+
+def run(options):
+    logger = get_logger()
+
+    topk = options.topk_splits
+    assert topk is not None, 'Set --topk_splits to the number of splits to keep.'
+
+    validation_dataset = get_validation_dataset(options)
+    validation_iterator = get_validation_iterator(options, validation_dataset)
+    embeddings = validation_dataset['embeddings']
+
+    logger.info('Initializing model.')
+    trainer = build_net(options, embeddings, validation_iterator)
+    net = trainer.get_single_net(trainer.net)
+    net.eval()
+
+    engine = DioraInference.from_net(net)
+    agreement = TreeAgreement()
+    cosine, count = 0, 0
+    elapsed, pruned_elapsed = 0, 0
+
+    batches = validation_iterator.get_iterator(random_seed=options.seed)
+
+    logger.info('Comparing top-{} splits against the exact chart.'.format(topk))
+
+    for batch_map in batches:
+        sentences = batch_map['sentences']
+        lengths = batch_map.get('lengths', None)
+        if sentences.shape[1] <= 2:
+            continue
+
+        trees, leaves, t = run_batch(engine, sentences, lengths, None)
+        pruned_trees, pruned_leaves, pruned_t = run_batch(engine, sentences, lengths, topk)
+
+        agreement.update(trees, pruned_trees)
+        elapsed += t
+        pruned_elapsed += pruned_t
+
+        # Outside vectors of the leaves, as used by the reconstruction loss.
+        sim = torch.nn.functional.cosine_similarity(leaves, pruned_leaves, dim=-1)
+        if lengths is not None:
+            mask = torch.arange(sentences.shape[1], device=sim.device).view(1, -1) < lengths.view(-1, 1)
+            sim = sim[mask]
+        cosine += sim.sum().item()
+        count += sim.numel()
+
+    result = agreement.get_result()
+    result['topk'] = topk
+    result['leaf_outside_cosine'] = cosine / max(count, 1)
+    result['exact_seconds'] = elapsed
+    result['pruned_seconds'] = pruned_elapsed
+    result['speedup'] = elapsed / max(pruned_elapsed, 1e-8)
+
+    logger.info('topk={} span_f1={:.4f} tree_agreement={:.4f} leaf_outside_cosine={:.4f} speedup={:.2f}'.format(
+        topk, result['span_f1'], result['tree_agreement'], result['leaf_outside_cosine'], result['speedup']))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    options = parse_args(parser)
+    configure(options)
+
+    run(options)
@@ -0,0 +1,84 @@
+import json
+import time
+
+from train import argument_parser, parse_args, configure
+from train import get_validation_dataset, get_validation_iterator
+from train import build_net
+
+from diora.logging.configuration import get_logger
+
+from diora.analysis.agreement import TreeAgreement
+from diora.net.inference import DioraInference
+from diora.net.leaf_table import LeafTable
+from diora.net.quantize import quantize
+
+
+def parse_all(engine, validation_iterator, options):
+    """
+    Returns {example_id: tree} for the validation data, and the total parsing time.
+
+    """
+    batches = validation_iterator.get_iterator(random_seed=options.seed)
+    trees = {}
+    elapsed = 0
+
+    for batch_map in batches:
+        sentences = batch_map['sentences']
+        if sentences.shape[1] <= 2:
+            continue
+
+        start = time.time()
+        batch_trees = engine.parse(sentences, lengths=batch_map.get('lengths', None))
+        elapsed += time.time() - start
+
+        for example_id, tr in zip(batch_map['example_ids'], batch_trees):
+            trees[example_id] = tr
+
+    return trees, elapsed
+
+
+def run(options):
+    logger = get_logger()
+
+    assert not options.cuda, 'Quantized kernels run on CPU only.'
+    assert not options.quantize, 'The model is quantized by this script. Do not set --quantize.'
+
+    validation_dataset = get_validation_dataset(options)
+    validation_iterator = get_validation_iterator(options, validation_dataset)
+    embeddings = validation_dataset['embeddings']
+
+    logger.info('Initializing model.')
+    trainer = build_net(options, embeddings, validation_iterator)
+    net = trainer.get_single_net(trainer.net)
+    net.diora.outside = False
+    net.eval()
+
+    logger.info('Parsing with fp32 weights.')
+    trees, elapsed = parse_all(DioraInference.from_net(net), validation_iterator, options)
+
+    logger.info('Parsing with int8 weights.')
+    quantize(net)
+    if net.leaf_table is not None:
+        net.leaf_table = LeafTable.build(net)
+    quantized_trees, quantized_elapsed = parse_all(DioraInference.from_net(net), validation_iterator, options)
+
+    example_ids = sorted(trees.keys())
+    agreement = TreeAgreement()
+    agreement.update([trees[k] for k in example_ids], [quantized_trees[k] for k in example_ids])
+
+    result = agreement.get_result()
+    result['fp32_seconds'] = elapsed
+    result['int8_seconds'] = quantized_elapsed
+    result['speedup'] = elapsed / max(quantized_elapsed, 1e-8)
+
+    logger.info('span_f1={:.4f} tree_agreement={:.4f} count={} speedup={:.2f}'.format(
+        result['span_f1'], result['tree_agreement'], result['count'], result['speedup']))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    options = parse_args(parser)
+    configure(options)
+
+    run(options)
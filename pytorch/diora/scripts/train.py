@@ -23,6 +23,9 @@ from diora.utils.checkpoint import save_experiment
 from diora.net.experiment_logger import ExperimentLogger
 
 from diora.analysis.cky import ParsePredictor as CKY
+from diora.net.diora import get_bracket_constraints
+from diora.net.inference import DioraInference
+from diora.net.chart_cache import ChartCache
 
 
 data_types_choices = ('nli', 'conll_jsonl', 'txt', 'txt_id', 'synthetic')
@@ -43,6 +46,73 @@ def build_net(options, embeddings, batch_iterator=None):
     return trainer
 
 
+def warmup_compiled(options, trainer, batch_iterator, mode='train'):
+    """
+    Compiles the level functions before the first real batch, and checks them against
+    the eager model on every batch shape of the iterator.
+
+    """
+    from diora.net.compiled import warmup
+
+    logger = get_logger()
+    shapes = [(batch_size, length) for batch_size, length in batch_iterator.get_batch_shapes()
+              if length > 2]
+    logger.info('Compiling {} batch shapes (mode={}).'.format(len(shapes), mode))
+    warmup(trainer.get_single_net(trainer.net).diora, shapes, mode=mode, tol=options.compile_parity_tol)
+
+
+def init_parse_cache(options, trainer, engine, dataset):
+    """
+    With --parse_cache, sets the cache of the inference engine, and resolves the
+    duplicate and cached sentences of `dataset` before batching. Returns the dataset to
+    batch, a dict from each example id to the example ids of its duplicates, and the
+    (example_ids, tokens, entry) of the cached sentences.
+
+    """
+    from diora.net.parse_cache import ParseCache, get_fingerprint, dedupe_dataset
+
+    if not options.parse_cache:
+        return dataset, {}, []
+
+    logger = get_logger()
+    net = trainer.get_single_net(trainer.net)
+    engine.cache = ParseCache(get_fingerprint(net), capacity=options.parse_cache_size,
+        path=options.parse_cache_path)
+
+    nsentences = len(dataset['sentences'])
+    dataset, duplicates, cached = dedupe_dataset(dataset, engine.cache, options.bracket_constraints)
+    logger.info('Parsing {} of {} sentences ({} in the parse cache).'.format(
+        len(dataset['sentences']), nsentences, len(cached)))
+
+    return dataset, duplicates, cached
+
+
+def init_span_memo(options, engine):
+    """
+    With --span_memo, sets the span memo of the inference engine.
+
+    """
+    from diora.net.span_memo import SpanMemo
+
+    if options.span_memo:
+        engine.span_memo = SpanMemo(capacity=options.span_memo_size, max_level=options.span_memo_max_level)
+
+
+def finish_inference(engine):
+    """
+    Logs the stats of the parse cache and the span memo, and closes the parse cache.
+
+    """
+    logger = get_logger()
+
+    if engine.cache is not None:
+        logger.info('Parse cache: {}'.format(json.dumps(engine.cache.get_stats())))
+        engine.cache.close()
+
+    if engine.span_memo is not None:
+        logger.info('Span memo: {}'.format(json.dumps(engine.span_memo.get_stats())))
+
+
 def generate_seeds(n, seed=11):
     random.seed(seed)
     seeds = [random.randint(0, 2**16) for _ in range(n)]
@@ -91,14 +161,30 @@ def run_parse(options, train_iterator, trainer, validation_iterator):
     ## Eval mode.
     trainer.net.eval()
 
-    ## Topk predictor.
-    parse_predictor = CKY(net=diora, word2idx=word2idx)
+    ## Inference engine. Parsing only needs the inside pass.
+    engine = DioraInference.from_net(trainer.get_single_net(trainer.net))
+    init_span_memo(options, engine)
+
+    ## Each distinct sentence is parsed once, and cached trees are not parsed again.
+    validation_dataset, duplicates, cached = init_parse_cache(options, trainer, engine, validation_dataset)
+    if options.parse_cache:
+        validation_iterator = get_validation_iterator(options, validation_dataset)
+
+    if options.compile:
+        warmup_compiled(options, trainer, validation_iterator, mode='inference')
 
     batches = validation_iterator.get_iterator(random_seed=options.seed)
 
     logger.info('Beginning to parse.')
 
     with torch.no_grad():
+        for example_ids, tokens, entry in cached:
+            tr = replace_leaves(entry['tree'], [idx2word[idx] for idx in tokens])
+            for example_id in example_ids:
+                o = dict(example_id=example_id, tree=tr)
+
+                print(json.dumps(o))
+
         for i, batch_map in enumerate(batches):
             sentences = batch_map['sentences']
             batch_size = sentences.shape[0]
@@ -109,25 +195,30 @@ def run_parse(options, train_iterator, trainer, validation_iterator):
                 for i in range(batch_size):
                     example_id = batch_map['example_ids'][i]
                     tokens = sentences[i].tolist()
+                    if batch_map.get('lengths', None) is not None:
+                        tokens = tokens[:batch_map['lengths'][i].item()]
                     words = [idx2word[idx] for idx in tokens]
-                    if length == 2:
-                        o = dict(example_id=example_id, tree=(words[0], words[1]))
-                    elif length == 1:
-                        o = dict(example_id=example_id, tree=words[0])
-                    print(json.dumps(o))
+                    for example_id in [example_id] + duplicates.get(example_id, []):
+                        if len(words) == 2:
+                            o = dict(example_id=example_id, tree=(words[0], words[1]))
+                        elif len(words) == 1:
+                            o = dict(example_id=example_id, tree=words[0])
+                        print(json.dumps(o))
                 continue
 
-            _ = trainer.step(batch_map, train=False, compute_loss=False)
-
-            trees = parse_predictor.parse_batch(batch_map)
+            constraints = get_bracket_constraints(batch_map, options.bracket_constraints)
+            trees = engine.parse(sentences, lengths=batch_map.get('lengths', None), constraints=constraints)
 
             for ii, tr in enumerate(trees):
                 example_id = batch_map['example_ids'][ii]
                 s = [idx2word[idx] for idx in sentences[ii].tolist()]
                 tr = replace_leaves(tr, s)
-                o = dict(example_id=example_id, tree=tr)
+                for example_id in [example_id] + duplicates.get(example_id, []):
+                    o = dict(example_id=example_id, tree=tr)
 
-                print(json.dumps(o))
+                    print(json.dumps(o))
+
+    finish_inference(engine)
 
 # Added now
 def str_to_tuple(tr):
@@ -201,6 +292,14 @@ def run_train(options, train_iterator, trainer, validation_iterator):
     parse_predictor = CKY(net=trainer.net.diora, word2idx=train_iterator.word2idx)
     # Added now
 
+    if options.finetune_chart_cache:
+        assert options.finetune, 'The chart cache requires --finetune.'
+        path = os.path.join(options.experiment_path, 'chart_cache')
+        if options.multigpu:
+            path = os.path.join(path, str(options.local_rank))
+        trainer.chart_cache = ChartCache(path, [len(x) for x in train_iterator.sentences],
+            trainer.get_single_net(trainer.net).diora)
+
     for epoch, seed in zip(range(options.max_epoch), seeds):
         # --- Train--- #
 
@@ -230,7 +329,7 @@ def run_train(options, train_iterator, trainer, validation_iterator):
 
         for batch_idx, batch_map in myiterator():
             if options.finetune and step >= options.finetune_after:
-                trainer.freeze_diora()
+                trainer.freeze_diora(embed=options.finetune_chart_cache)
 
             result = trainer.step(batch_map)
 
@@ -359,6 +458,12 @@ def run(options):
         run_parse(options, train_iterator, trainer, validation_iterator)
         sys.exit()
 
+    assert not options.leaf_table, 'The leaf table is not updated during training. Use it for evaluation only.'
+    assert not options.quantize, 'Quantized weights can not be trained. Use them for inference only.'
+
+    if options.compile:
+        warmup_compiled(options, trainer, train_iterator, mode='train')
+
     run_train(options, train_iterator, trainer, validation_iterator)
 
 
@@ -428,6 +533,77 @@ def argument_parser():
     parser.add_argument('--compress', action='store_true',
                         help='If true, then copy root from inside chart for outside. ' + \
                              'Otherwise, learn outside root as bias.')
+    parser.add_argument('--index_max_length', default=None, type=int,
+                        help='If set, then precompute the chart indices for every length ' + \
+                             'up to this value and memory-map them from a cache file.')
+    parser.add_argument('--index_cache_dir', default=None, type=str,
+                        help='Where to keep the index table. Defaults to the experiment path. ' + \
+                             'Processes that share this directory share the table.')
+    parser.add_argument('--chart_arena_mb', default=None, type=float,
+                        help='If set, then recycle chart buffers across batches, keeping at ' + \
+                             'most this many MB of unused buffers.')
+    parser.add_argument('--factorized', action='store_true',
+                        help='If true, then project each chart cell through the compose ' + \
+                             'and score functions once, rather than once per split.')
+    parser.add_argument('--fused_chart', action='store_true',
+                        help='If true, then store the h, c and s of each chart cell in one ' + \
+                             'buffer, so each level gathers its inputs once per side.')
+    parser.add_argument('--checkpoint_every', default=None, type=int,
+                        help='If set, then checkpoint every k-th level of the inside and ' + \
+                             'outside passes, recomputing its intermediates in backward.')
+    parser.add_argument('--checkpoint_budget_mb', default=None, type=float,
+                        help='If set, then checkpoint the largest levels until the estimated ' + \
+                             'memory kept for backward fits in this many MB.')
+    parser.add_argument('--chunk_budget_mb', default=None, type=float,
+                        help='If set, then compute each level in chunks of positions, so that ' + \
+                             'the intermediates of a chunk fit in this many MB.')
+    parser.add_argument('--leaf_table', action='store_true',
+                        help='If true, then precompute the leaves of every vocabulary entry ' + \
+                             'and read them from a table in eval mode.')
+    parser.add_argument('--save_leaf_table', action='store_true',
+                        help='If true, then keep the leaf table next to --load_model_path ' + \
+                             'and reuse it while it is up to date.')
+    parser.add_argument('--topk_splits', default=None, type=int,
+                        help='If set, then only compose and aggregate the k highest scoring ' + \
+                             'splits of each cell, and the outside pairs that use them.')
+    parser.add_argument('--max_span_width', default=None, type=int,
+                        help='If set, then the chart only has the spans of up to this many tokens, ' + \
+                             'and longer inputs are parsed in chunks that are joined right-branching.')
+    parser.add_argument('--bracket_constraints', default=None, choices=('spans', 'entity_labels'),
+                        help='If set, then read the known brackets of each sentence from this batch ' + \
+                             'field, and skip the splits that cross them in the chart and in CKY.')
+    parser.add_argument('--parse_cache', action='store_true',
+                        help='If true, then parse each distinct sentence once, and cache the trees ' + \
+                             'by model fingerprint and token ids.')
+    parser.add_argument('--parse_cache_size', default=100000, type=int,
+                        help='The number of trees that the parse cache keeps in memory.')
+    parser.add_argument('--parse_cache_path', default=None, type=str,
+                        help='If set, then the parse cache is also kept in this sqlite file.')
+    parser.add_argument('--span_memo', action='store_true',
+                        help='If true, then at inference the inside cells of spans that repeat across ' + \
+                             'sentences and recent batches are composed once.')
+    parser.add_argument('--span_memo_size', default=100000, type=int,
+                        help='The number of spans per level that the span memo keeps.')
+    parser.add_argument('--span_memo_max_level', default=4, type=int,
+                        help='The span memo only keeps the levels up to this one (spans of up to level + 1 tokens).')
+    parser.add_argument('--precision', default='fp32', choices=('fp32', 'bf16'),
+                        help='If bf16, then run the compose and score matmuls under autocast. ' + \
+                             'Softmax, normalization and losses stay in fp32.')
+    parser.add_argument('--precision_shadow_every', default=1000, type=int,
+                        help='With --precision, compare a fp32 run of the batch every k ' + \
+                             'train steps and log the divergence. 0 to disable.')
+    parser.add_argument('--chart_precision', default='fp32', choices=('fp32', 'fp16', 'bf16'),
+                        help='Store the chart h and c in this precision when running without ' + \
+                             'gradients (parsing, evaluation). Scores stay in fp32.')
+    parser.add_argument('--compile', action='store_true',
+                        help='If true, then compile the inside and outside level functions ' + \
+                             'with torch.compile, warming up every batch shape at startup.')
+    parser.add_argument('--quantize', action='store_true',
+                        help='If true, then use int8 copies of the compose, score and ' + \
+                             'embedding matrices. CPU inference only.')
+    parser.add_argument('--compile_parity_tol', default=1e-4, type=float,
+                        help='Largest difference from the eager model allowed during the ' + \
+                             'compile warmup.')
 
     # Model (Objective).
     parser.add_argument('--reconstruct_mode', default='margin', choices=('margin', 'softmax', 'semi'))
@@ -458,6 +634,9 @@ def argument_parser():
                              'of length 10-19 will have batch size 32, 20 or greater' + \
                              'will have batch size 16, and less than 10 will have batch size' + \
                              'equal to the batch_size arg. Only applies to training.')
+    parser.add_argument('--packed', action='store_true',
+                        help='If true, then batch sentences of different lengths together ' + \
+                             '(padded and masked), rather than only sentences of the same length.')
     parser.add_argument('--train_dataset_size', default=None, type=int)
     parser.add_argument('--validation_dataset_size', default=None, type=int)
     parser.add_argument('--validation_batch_size', default=None, type=int)
@@ -465,6 +644,10 @@ def argument_parser():
     parser.add_argument('--max_step', default=None, type=int)
     parser.add_argument('--finetune', action='store_true')
     parser.add_argument('--finetune_after', default=0, type=int)
+    parser.add_argument('--finetune_chart_cache', action='store_true',
+                        help='With --finetune, also freeze the embedding projection, and cache the chart ' + \
+                             'of each training example after its first step, so that the later epochs ' + \
+                             'only run the losses.')
 
     # Optimization.
     parser.add_argument('--lr', default=4e-3, type=float)
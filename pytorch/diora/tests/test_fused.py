@@ -0,0 +1,22 @@
+import torch
+
+from diora.net.diora import DioraTreeLSTM, DioraMLP
+
+
+def run(cls, fused, length):
+    torch.manual_seed(11)
+    diora = cls(8, outside=True, normalize='unit', fused=fused)
+    x = torch.randn(2, length, 8, requires_grad=True)
+    diora(x)
+    (diora.outside_h.sum() + diora.inside_h.sum()).backward()
+    return diora.outside_h.detach(), x.grad
+
+
+def test_fused_length_one():
+    # The leaves and the outside root are the whole chart.
+    for cls in (DioraTreeLSTM, DioraMLP):
+        for length in (1, 3):
+            h, grad = run(cls, False, length)
+            fused_h, fused_grad = run(cls, True, length)
+            assert torch.allclose(h, fused_h, atol=1e-6)
+            assert torch.allclose(grad, fused_grad, atol=1e-6)